@@ -1,19 +1,66 @@
 """Helper class for configuring Matrix."""
+import csv
+import hashlib
+import hmac
+import json
+import os
+import re
+import shutil
 import socket
+import threading
+import time
+import unicodedata
+from contextlib import contextmanager
 from random import SystemRandom
 import string
 
-import psycopg2
+import yaml
 from os import path
-from subprocess import check_output
+from subprocess import check_call, check_output
 
 from charmhelpers.core import hookenv, host, templating, unitdata
 from charms.reactive.helpers import any_file_changed
-from signedjson.key import generate_signing_key, write_signing_keys
 
 from charms.layer import snap
 
 
+def bcrypt_hash_password(password, pepper="", rounds=12):
+    """
+    Hash a password the same way synapse does, with bcrypt and the configured pepper.
+
+    bcrypt only uses the first 72 bytes of its input, older releases truncated longer
+    input silently while newer ones reject it, so it is truncated here to match.
+    """
+    import bcrypt
+
+    password = unicodedata.normalize("NFKC", password)
+    return bcrypt.hashpw(
+        (password.encode("utf8") + pepper.encode("utf8"))[:72], bcrypt.gensalt(rounds)
+    ).decode("ascii")
+
+
+def parse_duration(value):
+    """Return the number of seconds in a duration such as 30d, 12h or 90 (seconds)."""
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+    value = str(value).strip().lower()
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def parse_size(value):
+    """Return the number of bytes in a size such as 10M, 1G or 512 (bytes)."""
+    units = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+    value = str(value).strip().lower()
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value or 0)
+
+
+# Modules only needed by specific actions or hooks, such as psycopg2, signedjson,
+# bcrypt, http.client and charmhelpers.fetch, are imported where they are used to
+# keep hook startup fast
+
 # TODO: limits.conf file handle config
 # TODO: handle federation bridges install
 # TODO: libjemalloc
@@ -29,17 +76,325 @@ class MatrixHelper:
     synapse_snap = "matrix-synapse"
     synapse_service = "snap.matrix-synapse.matrix-synapse"
     synapse_conf_dir = "/var/snap/matrix-synapse/common/"
+    synapse_log_config = "/var/snap/matrix-synapse/common/log.yaml"
     synapse_signing_key_file = None
 
+    synapse_worker_conf_dir = "/var/snap/matrix-synapse/common/workers/"
+    synapse_worker_service_dir = "/etc/systemd/system/"
+    synapse_worker_service_prefix = "matrix-synapse-worker-"
+    synapse_replication_port = 9093
+    synapse_worker_base_port = 8083
+    synapse_metrics_port = 9000
+    synapse_worker_metrics_base_port = 9101
+    synapse_metrics_path = "/_synapse/metrics"
+    uploads_tmpfs_path = "/var/snap/matrix-synapse/common/uploads-tmpfs"
+
+    # Worker types which can be requested via the workers config option, mapped
+    # to the listener resources each worker type serves
+    synapse_worker_resources = {
+        "synchrotron": ["client"],
+        "client_reader": ["client"],
+        "event_creator": ["client"],
+        "federation_reader": ["federation"],
+        "federation_inbound": ["federation"],
+        "media_repository": ["media"],
+    }
+    peer_relation = "matrix-peers"
+    synapse_health_path = "/health"
+
+    # URL paths the reverse proxy routes to each worker type, as urlbase prefixes or
+    # urlregex patterns. Sync is balanced on the access token, so requests from a
+    # user reach the same synchrotron and its per-user caches stay warm.
+    synapse_client_path = r"^/_matrix/client/(api/v1|r0|v3|unstable)"
+    synapse_worker_routes = {
+        "synchrotron": [
+            {
+                "urlregex": synapse_client_path
+                + r"/(sync|events|initialSync|rooms/[^/]+/initialSync)(\?|$)",
+                "balance": "hdr(Authorization)",
+            },
+        ],
+        "client_reader": [
+            {
+                "urlregex": synapse_client_path
+                + r"/rooms/[^/]+/(messages|context|members|relations|event)"
+            },
+            {"urlregex": synapse_client_path + r"/publicRooms(\?|$)"},
+        ],
+        "event_creator": [
+            {
+                "urlregex": synapse_client_path
+                + r"/rooms/[^/]+/(send|state|redact|join|invite|leave|ban|unban|kick)"
+            },
+            {"urlregex": synapse_client_path + r"/(join|profile)/"},
+        ],
+        "federation_reader": [
+            {"urlbase": "/_matrix/federation/"},
+            {"urlbase": "/_matrix/key/v2/query"},
+        ],
+        "federation_inbound": [{"urlregex": r"^/_matrix/federation/v1/send/"}],
+        "media_repository": [
+            {"urlbase": "/_matrix/media/"},
+            {"urlbase": "/_matrix/client/v1/media/"},
+            {"urlbase": "/_matrix/federation/v1/media/"},
+            {"urlregex": r"^/_synapse/admin/v1/(purge_media_cache|room/.*/media|user/.*/media|media/)"},
+        ],
+        "user_dir": [{"urlregex": synapse_client_path + r"/user_directory/search(\?|$)"}],
+        "typing_writer": [{"urlregex": synapse_client_path + r"/rooms/[^/]+/typing"}],
+        "to_device_writer": [{"urlregex": synapse_client_path + r"/sendToDevice/"}],
+        "account_data_writer": [
+            {"urlregex": synapse_client_path + r"/.*/(tags|account_data)"}
+        ],
+        "receipts_writer": [
+            {"urlregex": synapse_client_path + r"/rooms/[^/]+/(receipt|read_markers)"}
+        ],
+        "presence_writer": [{"urlregex": synapse_client_path + r"/presence/"}],
+    }
+
+    # Worker types which hold no state of their own, so can also run on units other
+    # than the main unit, other worker types run only alongside the main process.
+    synapse_stateless_worker_types = (
+        "synchrotron",
+        "client_reader",
+        "event_creator",
+        "federation_reader",
+        "federation_inbound",
+    )
+    # Worker types whose instance counts are set by their own config option rather
+    # than the workers option, mapped to the option and the resources they serve.
+    # Only the health check is served by workers which handle no HTTP requests.
+    synapse_worker_count_options = {
+        "federation_sender": ("federation-senders", ["health"]),
+        "event_persister": ("event-persisters", ["health"]),
+        "pusher": ("pushers", ["health"]),
+        "appservice": ("appservice-worker", ["health"]),
+        "user_dir": ("user-directory-worker", ["client"]),
+        "background_worker": ("background-worker", ["health"]),
+    }
+    # Streams which can be written by workers via the stream-writers option, mapped
+    # to the maximum number of writers synapse supports for each, None if unlimited
+    synapse_stream_writer_limits = {
+        "typing": 1,
+        "to_device": None,
+        "account_data": None,
+        "receipts": None,
+        "presence": 1,
+    }
+    # Workers which write streams serve replication to the other processes on a
+    # local listener, and are listed in the instance map
+    synapse_worker_replication_base_port = 9201
+
+    # How changes to homeserver.yaml keys are applied, either a reload via SIGHUP, a
+    # restart of the main process only, or a restart of the main process and the
+    # workers serving a listener resource or of a worker type, where a tuple names
+    # several. Changes to other keys restart everything.
+    synapse_change_actions = {
+        "caches.global_factor": "reload",
+        "caches.per_cache_factors": "reload",
+        "report_stats": "main",
+        # Outbound federation requests are made by federation senders and remote
+        # media is fetched by media workers, as well as by the main process
+        "federation_ip_range_blacklist": ("federation", "federation_sender", "media"),
+        "use_presence": "client",
+        "require_auth_for_profile_requests": "client",
+        "allow_public_rooms_without_auth": "client",
+        "default_room_version": "client",
+        "block_non_admin_invites": "client",
+        "enable_search": "client",
+        "bcrypt_rounds": "client",
+        "enable_registration": "client",
+        "user_directory": "client",
+        "enable_room_list_search": "client",
+        "allow_public_rooms_over_federation": "federation",
+        "federation_domain_whitelist": ("federation", "federation_sender"),
+        "rc_message": "client",
+        "rc_registration": "client",
+        "rc_login": "client",
+        "rc_joins": "client",
+        "rc_federation": "federation",
+        "max_upload_size": "media",
+        "max_image_pixels": "media",
+        "dynamic_thumbnails": "media",
+    }
+
+    redis_package = "redis-server"
+    redis_service = "redis-server"
+    redis_local_host = "127.0.0.1"
+    redis_local_port = 6379
+
     matrix_ircd_snap = "matrix-ircd"
     matrix_ircd_service = "snap.matrix-ircd.matrix-ircd"
     matrix_ircd_conf_dir = "/var/snap/matrix-ircd/common/"
     matrix_ircd_config = "/var/snap/matrix-ircd/common/matrix-ircd.env"
 
     db_name = "matrix"
+    # The local synapse client listener used for admin API requests
+    admin_api_host = "127.0.0.1"
+    admin_api_port = 8008
+    admin_api_timeout = 30
+    register_concurrency = 8
+    # Rate limit settings which can be set by presets and the rate-limit-overrides
+    # config, mapped to the fields of each setting
+    rate_limit_fields = {
+        "rc_message": ("per_second", "burst_count"),
+        "rc_registration": ("per_second", "burst_count"),
+        "rc_login.address": ("per_second", "burst_count"),
+        "rc_login.account": ("per_second", "burst_count"),
+        "rc_login.failed_attempts": ("per_second", "burst_count"),
+        "rc_joins.local": ("per_second", "burst_count"),
+        "rc_joins.remote": ("per_second", "burst_count"),
+        "rc_federation": (
+            "window_size",
+            "sleep_limit",
+            "sleep_delay",
+            "reject_limit",
+            "concurrent",
+        ),
+    }
+    rate_limit_presets = {
+        "small": {
+            "rc_message.per_second": 0.2,
+            "rc_message.burst_count": 10,
+            "rc_registration.per_second": 0.05,
+            "rc_registration.burst_count": 2,
+            "rc_login.address.per_second": 0.1,
+            "rc_login.address.burst_count": 3,
+            "rc_login.account.per_second": 0.1,
+            "rc_login.account.burst_count": 3,
+            "rc_login.failed_attempts.per_second": 0.1,
+            "rc_login.failed_attempts.burst_count": 3,
+            "rc_joins.local.per_second": 0.1,
+            "rc_joins.local.burst_count": 10,
+            "rc_joins.remote.per_second": 0.01,
+            "rc_joins.remote.burst_count": 10,
+            "rc_federation.window_size": 1000,
+            "rc_federation.sleep_limit": 10,
+            "rc_federation.sleep_delay": 500,
+            "rc_federation.reject_limit": 50,
+            "rc_federation.concurrent": 3,
+        },
+        "medium": {
+            "rc_message.per_second": 0.5,
+            "rc_message.burst_count": 20,
+            "rc_registration.per_second": 0.17,
+            "rc_registration.burst_count": 3,
+            "rc_login.address.per_second": 0.3,
+            "rc_login.address.burst_count": 5,
+            "rc_login.account.per_second": 0.3,
+            "rc_login.account.burst_count": 5,
+            "rc_login.failed_attempts.per_second": 0.17,
+            "rc_login.failed_attempts.burst_count": 3,
+            "rc_joins.local.per_second": 0.2,
+            "rc_joins.local.burst_count": 20,
+            "rc_joins.remote.per_second": 0.03,
+            "rc_joins.remote.burst_count": 10,
+            "rc_federation.window_size": 1000,
+            "rc_federation.sleep_limit": 50,
+            "rc_federation.sleep_delay": 250,
+            "rc_federation.reject_limit": 200,
+            "rc_federation.concurrent": 5,
+        },
+        "large": {
+            "rc_message.per_second": 1,
+            "rc_message.burst_count": 50,
+            "rc_registration.per_second": 0.5,
+            "rc_registration.burst_count": 10,
+            "rc_login.address.per_second": 1,
+            "rc_login.address.burst_count": 10,
+            "rc_login.account.per_second": 0.5,
+            "rc_login.account.burst_count": 5,
+            "rc_login.failed_attempts.per_second": 0.17,
+            "rc_login.failed_attempts.burst_count": 3,
+            "rc_joins.local.per_second": 0.5,
+            "rc_joins.local.burst_count": 50,
+            "rc_joins.remote.per_second": 0.1,
+            "rc_joins.remote.burst_count": 20,
+            "rc_federation.window_size": 1000,
+            "rc_federation.sleep_limit": 100,
+            "rc_federation.sleep_delay": 250,
+            "rc_federation.reject_limit": 500,
+            "rc_federation.concurrent": 10,
+        },
+        "bridge-heavy": {
+            "rc_message.per_second": 10,
+            "rc_message.burst_count": 100,
+            "rc_registration.per_second": 1,
+            "rc_registration.burst_count": 20,
+            "rc_login.address.per_second": 1,
+            "rc_login.address.burst_count": 20,
+            "rc_login.account.per_second": 1,
+            "rc_login.account.burst_count": 20,
+            "rc_login.failed_attempts.per_second": 0.17,
+            "rc_login.failed_attempts.burst_count": 3,
+            "rc_joins.local.per_second": 5,
+            "rc_joins.local.burst_count": 100,
+            "rc_joins.remote.per_second": 1,
+            "rc_joins.remote.burst_count": 50,
+            "rc_federation.window_size": 1000,
+            "rc_federation.sleep_limit": 100,
+            "rc_federation.sleep_delay": 250,
+            "rc_federation.reject_limit": 500,
+            "rc_federation.concurrent": 10,
+        },
+    }
+
+    # Admin user the charm registers for itself to call the synapse admin API
+    charm_admin_user = "matrix-charm-admin"
+    # Media is purged in windows of a day from the end of the previous purge, or
+    # from a month before the cutoff on the first purge
+    media_purge_batch = 86400
+    media_purge_initial_batches = 30
+    media_purge_kinds = ("remote", "local")
+    media_purge_script = "files/purge-media"
+    media_purge_unit_prefix = "matrix-purge-media-"
+    # Tables which are vacuumed and analyzed by database maintenance, unless set by
+    # the db-maintenance-tables option, the most frequently written synapse tables
+    db_maintenance_tables = (
+        "events",
+        "event_json",
+        "state_groups_state",
+        "device_lists_stream",
+        "receipts_linearized",
+    )
+    db_maintenance_script = "files/db-maintenance"
+    db_maintenance_unit = "matrix-db-maintenance"
+    # As VACUUM does not shrink indexes, b-tree indexes of at least db_reindex_min_bytes
+    # whose leaf pages are on average less than this percent full, as measured by
+    # pgstatindex, are reported as needing a REINDEX CONCURRENTLY. Freshly built
+    # indexes fill their leaves to about 90%.
+    db_reindex_max_leaf_density = 50
+    db_reindex_min_bytes = 8 * 1024 * 1024
+    # Without the pgstattuple extension providing pgstatindex, indexes this many times
+    # the size of their table are reported instead, a heuristic which also flags
+    # healthy tables with narrow rows and many indexes
+    db_reindex_size_ratio = 2.0
+    db_reindex_checks = {
+        "leaf-density": "b-tree leaf density measured by pgstatindex",
+        "size-ratio": "heuristic of indexes over twice their table size, pgstattuple is unavailable",
+    }
+    # Seconds to wait for a restarted synapse process to pass its health check
+    health_check_timeout = 120
+    health_check_interval = 2
+    # Connections kept free on the PostgreSQL server for administration and the
+    # charm itself when sizing the synapse connection pools automatically
+    pgsql_reserved_connections = 5
+    # Connections the charm itself may hold open to PostgreSQL during a hook, and
+    # the number of rows sent to the server per statement by batch queries
+    pgsql_pool_size = 4
+    pgsql_page_size = 500
+    # Share of physical memory, across all synapse processes, that autotuned caches
+    # target, and the approximate cache memory in megabytes each unit of cache factor
+    # allows a process. Synapse's own memory based autotuning needs jemalloc, which
+    # the confined synapse snap can not preload, so the cache factor is sized instead.
+    cache_target_memory_share = 0.4
+    cache_memory_per_factor = 1024
+    cache_min_factor = 0.5
+    log_levels = ("DEBUG", "INFO", "WARNING", "ERROR")
     external_port = 8008
     irc_internal_port = 6667
     irc_internal_listen = "0.0.0.0"
+    # Seconds a previously resolved FQDN or IP may be used for when resolution fails
+    resolution_ttl = 86400
 
     HEALTHY = "Matrix homeserver installed and configured"
 
@@ -47,38 +402,75 @@ class MatrixHelper:
         """Load hookenv key/value store and charm configuration."""
         self.charm_config = hookenv.config()
         self.kv = unitdata.kv()
-        if not self.synapse_signing_key_file:
-            self.synapse_signing_key_file = "{}/{}.signing.key".format(
-                self.synapse_conf_dir, self.get_server_name()
-            )
+        self._pgsql_pool = None
+        self._http_local = threading.local()
+        self._resolved = {}
+        self._leadership = {}
+        self._configure_scheduled = False
+        self.render_error = None
+        self._synapse_config_changes = None
+        self._changed_workers = []
+
+    def get_password_hash_config(self):
+        """Return the password pepper and bcrypt rounds from the rendered synapse configuration."""
+        synapse_config = self.load_synapse_config()
+        pepper = (synapse_config.get("password_config") or {}).get("pepper") or ""
+        rounds = int(synapse_config.get("bcrypt_rounds") or 12)
+        return pepper, rounds
 
     def hash_password(self, password):
-        """Hash password using the synapse hash_password tool."""
-        cmd = [
-            "snap",
-            "run",
-            "{}.hash-password".format(self.synapse_snap),
-            "-c",
-            self.synapse_config,
-            "-p",
-            password,
-        ]
-        result = check_output(cmd)
-        str_result = result.decode("utf-8")
-        return str_result.rstrip()
+        """Hash password using the pepper and bcrypt rounds synapse is configured with."""
+        pepper, rounds = self.get_password_hash_config()
+        return bcrypt_hash_password(password, pepper, rounds)
+
+    def hash_passwords(self, passwords):
+        """Hash a list of passwords in parallel across a process pool, returning hashes in order."""
+        from concurrent.futures import ProcessPoolExecutor
+
+        pepper, rounds = self.get_password_hash_config()
+        with ProcessPoolExecutor() as executor:
+            return list(
+                executor.map(
+                    bcrypt_hash_password,
+                    passwords,
+                    [pepper] * len(passwords),
+                    [rounds] * len(passwords),
+                )
+            )
+
+    def get_user_id(self, user):
+        """Return the fully qualified matrix user ID of a local user."""
+        if user.startswith("@"):
+            return user
+        return "@{}:{}".format(user, self.get_server_name())
 
     def set_password(self, user, password):
         """Set the password for a provided synapse user."""
         hashed_password = self.hash_password(password)
-        server_name = self.get_server_name()
         hookenv.log("Storing hash: {}".format(hashed_password), hookenv.DEBUG)
         result = self.pgsql_query(
-            "UPDATE users SET password_hash = '{}' WHERE name = '@{}:{}';".format(
-                hashed_password, user, server_name
-            )
+            "UPDATE users SET password_hash = %s WHERE name = %s;",
+            (hashed_password, self.get_user_id(user)),
         )
         return result
 
+    def set_passwords(self, passwords):
+        """
+        Set the passwords for many synapse users in a single transaction.
+
+        Takes a dict of user names to passwords, returning the list of user IDs
+        which were updated, or an error message.
+        """
+        users = list(passwords)
+        hashes = self.hash_passwords([passwords[user] for user in users])
+        return self.pgsql_batch(
+            "UPDATE users SET password_hash = data.password_hash "
+            "FROM (VALUES %s) AS data (name, password_hash) "
+            "WHERE users.name = data.name RETURNING users.name",
+            [(self.get_user_id(user), hashed) for user, hashed in zip(users, hashes)],
+            fetch=True,
+        )
+
     def register_user(self, user, password=None, admin=False):
         """Create a user with the provided credentials, and optionally set as an admin."""
         if not password:
@@ -103,16 +495,376 @@ class MatrixHelper:
         result = check_output(cmd)
         return result
 
-    def pgsql_query(self, query, values=None):
-        """Execute the provided query against the related database."""
-        if self.pgsql_configured():
-            connection = psycopg2.connect(
+    def get_admin_connection(self, port=None):
+        """Return a keep-alive HTTP connection to a local synapse listener for the current thread."""
+        import http.client
+
+        port = port or self.admin_api_port
+        connections = getattr(self._http_local, "connections", None)
+        if connections is None:
+            connections = self._http_local.connections = {}
+        if port not in connections:
+            connections[port] = http.client.HTTPConnection(
+                self.admin_api_host, port, timeout=self.admin_api_timeout
+            )
+        return connections[port]
+
+    def admin_api_request(self, method, api_path, body=None, token=None, port=None):
+        """
+        Send a request to the local synapse API, returning the status and decoded response.
+
+        Connections are kept alive and reused by later requests from the same
+        thread, reconnecting once if synapse has closed the connection. Requests
+        go to the main process unless the port of a worker is provided.
+        """
+        import http.client
+
+        headers = {"Content-Type": "application/json"}
+        if token:
+            headers["Authorization"] = "Bearer {}".format(token)
+        payload = json.dumps(body) if body is not None else None
+        connection = self.get_admin_connection(port)
+        try:
+            connection.request(method, api_path, body=payload, headers=headers)
+            response = connection.getresponse()
+        except (http.client.HTTPException, ConnectionError):
+            connection.close()
+            connection.request(method, api_path, body=payload, headers=headers)
+            response = connection.getresponse()
+        content = response.read()
+        try:
+            return response.status, json.loads(content.decode("utf-8")) if content else {}
+        except ValueError:
+            return response.status, {"error": content.decode("utf-8", "replace")}
+
+    def register_user_api(self, shared_secret, user, password=None, admin=False):
+        """
+        Register a user via the shared secret registration admin API.
+
+        Returns a tuple of success and a message describing the outcome.
+        """
+        if not password:
+            password = self.random_string(16)
+        status, response = self.admin_api_request("GET", "/_synapse/admin/v1/register")
+        if status != 200:
+            return False, response.get("error", "Unable to retrieve nonce")
+        mac = hmac.new(key=shared_secret.encode("utf8"), digestmod=hashlib.sha1)
+        for part in (response["nonce"], user, password):
+            mac.update(part.encode("utf8"))
+            mac.update(b"\x00")
+        mac.update(b"admin" if admin else b"notadmin")
+        status, response = self.admin_api_request(
+            "POST",
+            "/_synapse/admin/v1/register",
+            {
+                "nonce": response["nonce"],
+                "username": user,
+                "password": password,
+                "admin": bool(admin),
+                "mac": mac.hexdigest(),
+            },
+        )
+        if status != 200:
+            return False, response.get("error", "HTTP status {}".format(status))
+        return True, response.get("user_id", user)
+
+    def get_admin_access_token(self):
+        """
+        Return an access token for the charm's own synapse admin user.
+
+        The user is registered via the shared secret API and logged in on first
+        use, with the access token kept in the KV store. Returns None on failure.
+        """
+        token = self.kv.get("admin_access_token")
+        if token:
+            return token
+        password = self.get_token("admin_password")
+        self.register_user_api(
+            self.get_shared_secret(), self.charm_admin_user, password, admin=True
+        )
+        status, response = self.admin_api_request(
+            "POST",
+            "/_matrix/client/r0/login",
+            {"type": "m.login.password", "user": self.charm_admin_user, "password": password},
+        )
+        if status != 200:
+            hookenv.log(
+                "Unable to log in as {}: {}".format(
+                    self.charm_admin_user, response.get("error", status)
+                ),
+                hookenv.ERROR,
+            )
+            return None
+        self.kv.set("admin_access_token", response["access_token"])
+        return response["access_token"]
+
+    def synapse_admin_request(self, method, api_path, body=None, port=None):
+        """Send a request to the synapse admin API as the charm's admin user, logging in again if the token expired."""
+        for attempt in range(2):
+            token = self.get_admin_access_token()
+            if token is None:
+                return 401, {"error": "No access token for {}".format(self.charm_admin_user)}
+            status, response = self.admin_api_request(
+                method, api_path, body, token=token, port=port
+            )
+            if status != 401:
+                break
+            self.kv.unset("admin_access_token")
+        return status, response
+
+    def get_purge_batches(self, kind, before_ts):
+        """Return the increasing timestamps, in ms, to purge media up to before_ts in batches."""
+        batch = self.media_purge_batch * 1000
+        start = self.kv.get("media_purge_{}_ts".format(kind)) or (
+            before_ts - self.media_purge_initial_batches * batch
+        )
+        return list(range(start + batch, before_ts, batch)) + [before_ts]
+
+    def purge_media(self, kind, api_path, count_key, older_than):
+        """
+        Purge media older than the provided number of seconds in batches via the admin API.
+
+        Returns a tuple of success and either the number of media deleted, bytes freed
+        from the media store filesystem and run time, or an error message.
+        """
+        start = time.monotonic()
+        media_store_path = self.get_media_store_path()
+        used_before = shutil.disk_usage(media_store_path).used
+        before_ts = int((time.time() - older_than) * 1000)
+        # Media admin requests must be handled by the media repository when it is a worker
+        media_workers = self.get_media_workers()
+        port = media_workers[0]["port"] if media_workers else None
+        deleted = 0
+        for batch_ts in self.get_purge_batches(kind, before_ts):
+            status, response = self.synapse_admin_request(
+                "POST", api_path.format(before_ts=batch_ts), port=port
+            )
+            if status != 200:
+                self.kv.flush()
+                return False, response.get("error", "HTTP status {}".format(status))
+            deleted += response.get(count_key, 0)
+            self.kv.set("media_purge_{}_ts".format(kind), batch_ts)
+        self.kv.flush()
+        return (
+            True,
+            {
+                "deleted": deleted,
+                "bytes-freed": max(0, used_before - shutil.disk_usage(media_store_path).used),
+                "run-time": round(time.monotonic() - start, 3),
+            },
+        )
+
+    def purge_remote_media(self, older_than):
+        """Purge cached remote media not accessed for the provided number of seconds."""
+        return self.purge_media(
+            "remote", "/_synapse/admin/v1/purge_media_cache?before_ts={before_ts}", "deleted", older_than
+        )
+
+    def purge_local_media(self, older_than, larger_than=0):
+        """Purge local media not accessed for the provided number of seconds and larger than a size in bytes."""
+        return self.purge_media(
+            "local",
+            "/_synapse/admin/v1/media/{}/delete?before_ts={{before_ts}}&size_gt={}&keep_profiles=true".format(
+                self.get_server_name(), larger_than
+            ),
+            "total",
+            older_than,
+        )
+
+    def run_media_purge(self, kind):
+        """Purge remote or local media with the thresholds from charm config, as run by the purge timers."""
+        older_than = parse_duration(
+            self.charm_config.get("purge-{}-media-older-than".format(kind))
+        )
+        if kind == "remote":
+            success, result = self.purge_remote_media(older_than)
+        else:
+            success, result = self.purge_local_media(
+                older_than, parse_size(self.charm_config.get("purge-local-media-larger-than"))
+            )
+        hookenv.log(
+            "Scheduled {} media purge {}: {}".format(
+                kind, "completed" if success else "failed", result
+            ),
+            hookenv.INFO if success else hookenv.ERROR,
+        )
+        return success
+
+    def get_media_purge_schedule(self, kind):
+        """Return the configured schedule of a media purge, purges only run on the main unit."""
+        if not self.is_main_unit():
+            return None
+        return self.charm_config.get("purge-{}-media-schedule".format(kind))
+
+    def get_timers(self):
+        """Return the systemd timers running scheduled tasks, mapped to their description, schedule and command."""
+        timers = {}
+        for kind in self.media_purge_kinds:
+            timers["{}{}".format(self.media_purge_unit_prefix, kind)] = {
+                "description": "Purge {} Matrix media".format(kind),
+                "schedule": self.get_media_purge_schedule(kind),
+                "command": "{} {}".format(
+                    path.join(hookenv.charm_dir(), self.media_purge_script), kind
+                ),
+            }
+        timers[self.db_maintenance_unit] = {
+            "description": "Vacuum and analyze the Matrix database",
+            "schedule": self.get_db_maintenance_schedule(),
+            "command": path.join(hookenv.charm_dir(), self.db_maintenance_script),
+        }
+        return timers
+
+    def configure_timers(self):
+        """Install, update or remove the systemd timers running scheduled media purges and database maintenance."""
+        units_changed = False
+        timers = self.get_timers()
+        for unit_name, timer in timers.items():
+            service_file = path.join(self.synapse_worker_service_dir, unit_name + ".service")
+            timer_file = path.join(self.synapse_worker_service_dir, unit_name + ".timer")
+            if timer["schedule"]:
+                context = dict(
+                    timer, synapse_service=self.synapse_service, unit=hookenv.local_unit()
+                )
+                for source, target in (
+                    ("matrix-timer.service.j2", service_file),
+                    ("matrix-timer.timer.j2", timer_file),
+                ):
+                    if self.render_template(source, target, context, perms=0o644):
+                        units_changed = True
+            elif path.exists(timer_file):
+                hookenv.log("Removing {} timer".format(unit_name), hookenv.DEBUG)
+                host.service("stop", unit_name + ".timer")
+                host.service("disable", unit_name + ".timer")
+                self.remove_rendered_files(service_file, timer_file)
+                units_changed = True
+        if units_changed:
+            self.reload_systemd()
+        for unit_name, timer in timers.items():
+            if timer["schedule"]:
+                self.start_service(unit_name + ".timer")
+        return True
+
+    def parse_users(self, payload):
+        """
+        Parse a list of users to register from a JSON or CSV payload.
+
+        JSON payloads are a list of objects with user, password and admin keys.
+        CSV payloads have user, password and admin columns, with an optional header.
+        Raises ValueError for entries without a user name.
+        """
+        payload = payload.strip()
+        if payload.startswith("["):
+            users = json.loads(payload)
+        else:
+            rows = [row for row in csv.reader(payload.splitlines()) if row]
+            if rows and rows[0][0].strip().lower() == "user":
+                rows = rows[1:]
+            users = [
+                dict(zip(("user", "password", "admin"), [field.strip() for field in row]))
+                for row in rows
+            ]
+        if not isinstance(users, list):
+            raise ValueError("expected a list of users")
+        for index, user in enumerate(users, 1):
+            if not isinstance(user, dict) or not user.get("user"):
+                raise ValueError("entry {} has no user name".format(index))
+            admin = user.get("admin", False)
+            if not isinstance(admin, bool):
+                admin = str(admin).lower() in ("true", "yes", "1")
+            user["admin"] = admin
+        return users
+
+    def register_users(self, users, concurrency=None):
+        """
+        Register many users concurrently via the admin API.
+
+        Returns a list of per-user results and the elapsed time in seconds.
+        """
+        import http.client
+        from concurrent.futures import ThreadPoolExecutor
+
+        shared_secret = self.get_shared_secret()
+        concurrency = max(1, int(concurrency or self.register_concurrency))
+
+        def register(user):
+            try:
+                success, message = self.register_user_api(
+                    shared_secret, user["user"], user.get("password"), user.get("admin")
+                )
+            except (http.client.HTTPException, OSError, ValueError, KeyError) as e:
+                success, message = False, str(e)
+            return {
+                "user": user["user"],
+                "outcome": "success" if success else "failure",
+                "message": message,
+            }
+
+        hookenv.log(
+            "Registering {} users with concurrency {}".format(len(users), concurrency),
+            hookenv.DEBUG,
+        )
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(register, users))
+        return results, time.monotonic() - start
+
+    def get_pgsql_pool(self):
+        """
+        Return the PostgreSQL connection pool for this hook, creating it if required.
+
+        Connections are reused by every query made during the hook, and closed
+        when the hook exits.
+        """
+        import psycopg2.pool
+
+        if self._pgsql_pool is None:
+            self._pgsql_pool = psycopg2.pool.SimpleConnectionPool(
+                1,
+                self.pgsql_pool_size,
                 host=self.kv.get("pgsql_host"),
                 port=self.kv.get("pgsql_port"),
                 dbname=self.kv.get("pgsql_db"),
                 user=self.kv.get("pgsql_user"),
                 password=self.kv.get("pgsql_pass"),
             )
+            hookenv.atexit(self.close_pgsql_pool)
+        return self._pgsql_pool
+
+    def close_pgsql_pool(self):
+        """Close all pooled PostgreSQL connections."""
+        if self._pgsql_pool is not None:
+            self._pgsql_pool.closeall()
+            self._pgsql_pool = None
+
+    @contextmanager
+    def pgsql_transaction(self):
+        """Yield a cursor on a pooled connection, committing on success and rolling back on error."""
+        pool = self.get_pgsql_pool()
+        connection = pool.getconn()
+        connection.set_session(autocommit=False)
+        cursor = connection.cursor()
+        try:
+            yield cursor
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+            pool.putconn(connection)
+
+    def pgsql_query(self, query, values=None):
+        """
+        Execute the provided query against the related database.
+
+        Queries run outside of a transaction, returning the rows for queries that
+        produce a result set.
+        """
+        import psycopg2
+
+        if self.pgsql_configured():
+            pool = self.get_pgsql_pool()
+            connection = pool.getconn()
             connection.set_session(autocommit=True)
             cursor = connection.cursor()
             try:
@@ -121,6 +873,8 @@ class MatrixHelper:
                     hookenv.DEBUG,
                 )
                 result = cursor.execute(query, vars=values)
+                if cursor.description is not None:
+                    result = cursor.fetchall()
             except psycopg2.Error as e:
                 hookenv.log(
                     "Error {} from PostgreSQL when executing query {}".format(
@@ -129,12 +883,57 @@ class MatrixHelper:
                     hookenv.ERROR,
                 )
                 return e.diag.message_primary
+            finally:
+                cursor.close()
+                pool.putconn(connection)
             hookenv.log("Query result: {}".format(result), hookenv.DEBUG)
-            cursor.close()
-            connection.close()
             return result
         return False
 
+    def pgsql_batch(self, query, values_list, fetch=False):
+        """
+        Execute a parameterized query for each set of values in a single transaction.
+
+        Queries containing a VALUES %s placeholder are expanded with execute_values,
+        sending values to the server in pages, other queries use executemany.
+        Returns the resulting rows when fetch is set, otherwise True.
+        """
+        import psycopg2
+        import psycopg2.extras
+
+        if not self.pgsql_configured():
+            return False
+        hookenv.log(
+            "Executing batch query {} with {} sets of values".format(
+                query, len(values_list)
+            ),
+            hookenv.DEBUG,
+        )
+        try:
+            with self.pgsql_transaction() as cursor:
+                if "values %s" in query.lower():
+                    rows = psycopg2.extras.execute_values(
+                        cursor,
+                        query,
+                        values_list,
+                        page_size=self.pgsql_page_size,
+                        fetch=fetch,
+                    )
+                else:
+                    cursor.executemany(query, values_list)
+                    rows = cursor.fetchall() if fetch else None
+        except psycopg2.Error as e:
+            hookenv.log(
+                "Error {} from PostgreSQL when executing batch query {}".format(
+                    e.diag.message_primary, query
+                ),
+                hookenv.ERROR,
+            )
+            return e.diag.message_primary
+        if fetch:
+            return rows
+        return True
+
     def pgsql_create_db(self, name):
         """Create the named PostgreSQL database."""
         flag = "pgsql_created_{}".format(name)
@@ -159,44 +958,237 @@ class MatrixHelper:
                     return create_result
         return False
 
+    def get_db_maintenance_tables(self, tables=None):
+        """
+        Return the tables to maintain from a comma separated list, or from charm config if not provided.
+
+        Raises ValueError for names which are not plain table names, as they are
+        interpolated into VACUUM statements.
+        """
+        if not tables:
+            tables = self.charm_config.get("db-maintenance-tables") or ",".join(
+                self.db_maintenance_tables
+            )
+        table_names = [table.strip() for table in tables.split(",") if table.strip()]
+        for table in table_names:
+            if not re.match(r"^[a-z_][a-z0-9_]*$", table):
+                raise ValueError("invalid table name {}".format(table))
+        return table_names
+
+    def get_bloated_indexes(self, tables):
+        """
+        Return a dict of the provided tables to their bloated b-tree indexes, measured by pgstatindex.
+
+        pgstatindex reads each index in full to measure the density of its leaf pages.
+        Returns None if pgstatindex is unavailable, as the pgstattuple extension is not
+        installed or the charm's database user may not use it.
+        """
+        rows = self.pgsql_query(
+            "SELECT i.relname, i.indexrelname FROM pg_stat_user_indexes i "
+            "JOIN pg_index x ON x.indexrelid = i.indexrelid AND x.indisvalid "
+            "JOIN pg_class c ON c.oid = i.indexrelid "
+            "JOIN pg_am a ON a.oid = c.relam AND a.amname = 'btree', "
+            "LATERAL pgstatindex(i.indexrelid::regclass) s "
+            "WHERE i.relname = ANY(%s) AND pg_relation_size(i.indexrelid) >= %s "
+            "AND s.avg_leaf_density < %s ORDER BY i.relname, i.indexrelname;",
+            (tables, self.db_reindex_min_bytes, self.db_reindex_max_leaf_density),
+        )
+        if not isinstance(rows, list):
+            hookenv.log(
+                "Unable to measure index bloat with pgstatindex, using index sizes: {}".format(rows),
+                hookenv.WARNING,
+            )
+            return None
+        bloated_indexes = {}
+        for table, index in rows:
+            bloated_indexes.setdefault(table, []).append(index)
+        return bloated_indexes
+
+    def get_table_stats(self, tables):
+        """
+        Return the dead tuple ratio, table and index sizes of the provided tables from pg_stat_user_tables.
+
+        Tables with bloated indexes, by leaf density where pgstatindex is available and
+        otherwise by the size of their indexes, are flagged as needing a REINDEX
+        CONCURRENTLY, along with the check used. Returns the error message from
+        PostgreSQL if the statistics can not be queried.
+        """
+        rows = self.pgsql_query(
+            "SELECT relname, n_live_tup, n_dead_tup, pg_table_size(relid), "
+            "pg_indexes_size(relid), greatest(last_vacuum, last_autovacuum), "
+            "greatest(last_analyze, last_autoanalyze) "
+            "FROM pg_stat_user_tables WHERE relname = ANY(%s) ORDER BY relname;",
+            (tables,),
+        )
+        if not isinstance(rows, list):
+            return rows
+        bloated_indexes = self.get_bloated_indexes(tables)
+        table_stats = {}
+        for table, live, dead, table_bytes, index_bytes, vacuumed, analyzed in rows:
+            if bloated_indexes is None:
+                reindex_check = "size-ratio"
+                needs_reindex = index_bytes > table_bytes * self.db_reindex_size_ratio
+            else:
+                reindex_check = "leaf-density"
+                needs_reindex = table in bloated_indexes
+            table_stats[table] = {
+                "dead-ratio": round(dead / (live + dead), 3) if live + dead else 0.0,
+                "dead-tuples": dead,
+                "table-bytes": table_bytes,
+                "index-bytes": index_bytes,
+                "last-vacuum": str(vacuumed) if vacuumed else "never",
+                "last-analyze": str(analyzed) if analyzed else "never",
+                "needs-reindex": needs_reindex,
+                "bloated-indexes": (bloated_indexes or {}).get(table, []),
+                "reindex-check": reindex_check,
+            }
+        return table_stats
+
+    def run_db_maintenance(self, tables=None, vacuum=True):
+        """
+        Report the bloat of the provided tables then VACUUM (ANALYZE) them one at a time.
+
+        Statistics are reported as they were before vacuuming, when the dead tuples
+        are still counted. Returns a tuple of success and the report, or an error message.
+        """
+        start = time.monotonic()
+        try:
+            tables = self.get_db_maintenance_tables(tables)
+        except ValueError as e:
+            return False, str(e)
+        table_stats = self.get_table_stats(tables)
+        if not isinstance(table_stats, dict):
+            return False, table_stats
+        vacuumed = []
+        if vacuum:
+            for table in tables:
+                if table not in table_stats:
+                    hookenv.log("Skipping vacuum of missing table {}".format(table), hookenv.WARNING)
+                    continue
+                error = self.pgsql_query('VACUUM (ANALYZE) "{}";'.format(table))
+                if error is not None:
+                    return False, "Unable to vacuum {}: {}".format(table, error)
+                vacuumed.append(table)
+        return True, {
+            "tables": table_stats,
+            "vacuumed": vacuumed,
+            "reindex": [table for table, stats in table_stats.items() if stats["needs-reindex"]],
+            "reindex-check": ", ".join(
+                sorted(set(self.db_reindex_checks[stats["reindex-check"]] for stats in table_stats.values()))
+            ),
+            "run-time": round(time.monotonic() - start, 3),
+        }
+
+    def run_scheduled_db_maintenance(self):
+        """Vacuum and analyze the tables from charm config, as run by the database maintenance timer."""
+        success, result = self.run_db_maintenance()
+        hookenv.log(
+            "Scheduled database maintenance {}: {}".format(
+                "completed" if success else "failed", result
+            ),
+            hookenv.INFO if success else hookenv.ERROR,
+        )
+        if success and result["reindex"]:
+            hookenv.log(
+                "Tables needing REINDEX CONCURRENTLY, by {}: {}".format(
+                    result["reindex-check"], ", ".join(result["reindex"])
+                ),
+                hookenv.WARNING,
+            )
+        return success
+
+    def get_db_maintenance_schedule(self):
+        """Return the configured schedule of database maintenance, which runs only on the main unit."""
+        if not self.is_main_unit():
+            return None
+        return self.charm_config.get("db-maintenance-schedule")
+
     def random_string(self, length):
         """Implement the random_string function from the synapse stringutils package."""
         return "".join(
             SystemRandom().choice(string.ascii_letters) for _ in range(length)
         )
 
+    def is_leader(self):
+        """Return True if this unit is the leader, checked at most once per hook."""
+        if "leader" not in self._leadership:
+            self._leadership["leader"] = hookenv.is_leader()
+        return self._leadership["leader"]
+
+    def leader_get(self, name):
+        """Return the named leader setting, with the leader settings read at most once per hook."""
+        if "settings" not in self._leadership:
+            self._leadership["settings"] = hookenv.leader_get() or {}
+        return self._leadership["settings"].get(name)
+
+    def leader_set(self, settings):
+        """Set leader settings, keeping the settings read during the hook up to date."""
+        hookenv.leader_set(settings)
+        if "settings" in self._leadership:
+            self._leadership["settings"].update(settings)
+
+    def get_leader_secret(self, name, generate=None):
+        """
+        Return a secret shared by the leader with every unit via leader settings.
+
+        The leader generates the secret if it is not set yet, adopting the value from
+        its own KV store where one exists so single unit deployments keep their secrets.
+        Returns None on other units until the leader has shared the secret.
+        """
+        secret = self.leader_get(name)
+        if not secret and self.is_leader():
+            secret = self.kv.get(name) or (generate() if generate else self.random_string(24))
+            self.leader_set({name: secret})
+        return secret
+
     def get_token(self, name):
         """
         Return a 24 character token.
 
-        The token will be stored in KV as the provided
-        name and returned from KV is preexisting.
+        The token is generated by the leader and shared with every unit
+        under the provided name.
         """
-        if self.kv.get(name):
-            return self.kv.get(name)
-        token = self.random_string(24)
-        self.kv.set(name, token)
-        return token
+        return self.get_leader_secret(name)
 
     def get_shared_secret(self):
-        """Generate a shared secret for registration."""
+        """Return the shared secret for registration, from config or generated by the leader."""
         shared_secret = self.charm_config.get("shared-secret")
-        saved_shared_secret = self.kv.get("shared-secret")
-        if not shared_secret:
-            if saved_shared_secret:
-                return saved_shared_secret
-            else:
-                shared_secret = self.random_string(16)
-                self.kv.set("shared-secret", shared_secret)
-        return shared_secret
+        if shared_secret:
+            return shared_secret
+        return self.get_leader_secret("shared-secret", lambda: self.random_string(16))
+
+    def get_replication_secret(self):
+        """Return the secret workers authenticate to replication listeners with."""
+        return self.get_leader_secret("replication-secret")
 
     def get_synapse_signing_key(self):
-        """Return the path of the synapse signing key, generating it if missing."""
-        if not path.exists(self.synapse_signing_key_file):
-            key_id = "a_" + self.random_string(4)
-            key_content = generate_signing_key(key_id)
-            with open(self.synapse_signing_key_file, "w+") as key_file:
-                write_signing_keys(key_file, (key_content,))
+        """
+        Return the path of the synapse signing key, written from the key shared by the leader.
+
+        The leader shares its existing key, or generates one, so that every unit presents
+        the same server identity. Returns None until the leader has shared the key.
+        """
+        if not self.synapse_signing_key_file:
+            self.synapse_signing_key_file = "{}/{}.signing.key".format(
+                self.synapse_conf_dir, self.get_server_name()
+            )
+        signing_key = self.leader_get("signing-key")
+        if not signing_key and self.is_leader():
+            if path.exists(self.synapse_signing_key_file):
+                with open(self.synapse_signing_key_file) as key_file:
+                    signing_key = key_file.read()
+            else:
+                import io
+                from signedjson.key import generate_signing_key, write_signing_keys
+
+                key_id = "a_" + self.random_string(4)
+                key_stream = io.StringIO()
+                write_signing_keys(key_stream, (generate_signing_key(key_id),))
+                signing_key = key_stream.getvalue()
+            self.leader_set({"signing-key": signing_key})
+        if not signing_key:
+            return None
+        host.write_file(self.synapse_signing_key_file, signing_key.encode("utf-8"), perms=0o600)
         return self.synapse_signing_key_file
 
     def restart_matrix_ircd(self):
@@ -206,8 +1198,155 @@ class MatrixHelper:
         return True
 
     def restart_synapse(self):
-        """Restart services."""
-        return host.service("restart", self.synapse_service)
+        """Restart services, rolling through the workers before the main process."""
+        return self.rolling_restart()
+
+    def check_health(self, port):
+        """Return True if the synapse listener on the local port reports it is healthy."""
+        import http.client
+
+        connection = http.client.HTTPConnection(
+            self.admin_api_host, port, timeout=self.health_check_interval
+        )
+        try:
+            connection.request("GET", "/health")
+            response = connection.getresponse()
+            return response.status == 200 and response.read().strip() == b"OK"
+        except (OSError, http.client.HTTPException):
+            return False
+        finally:
+            connection.close()
+
+    def wait_for_health(self, port):
+        """Wait for the synapse listener on the local port to become healthy, returning False on timeout."""
+        deadline = time.monotonic() + self.health_check_timeout
+        while not self.check_health(port):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(self.health_check_interval)
+        return True
+
+    def rolling_restart(self, workers=None, restart_main=None):
+        """
+        Restart synapse workers one at a time followed by the main process.
+
+        Workers are restarted grouped by type and each must pass its health check before
+        the next is restarted, so a worker type is never entirely down at once. When a
+        health check fails the remaining workers are left running and recorded in the
+        KV store, to be restarted with the next change applied, but the main process is
+        still restarted so it runs the current configuration. Returns False if any
+        health check fails. The main process is restarted by default only on the main unit.
+        """
+        if restart_main is None:
+            restart_main = self.is_main_unit()
+        if workers is None:
+            workers = self.get_workers()
+        pending_restarts = set(self.kv.get("pending_restarts", []))
+        healthy = True
+        workers = sorted(workers, key=lambda worker: (worker["type"], worker["port"]))
+        for index, worker in enumerate(workers):
+            hookenv.log("Restarting {}".format(worker["service"]), hookenv.DEBUG)
+            host.service("restart", worker["service"])
+            pending_restarts.discard(worker["name"])
+            if not self.wait_for_health(worker["port"]):
+                hookenv.log(
+                    "{} failed its health check, stopping rolling restart of workers".format(
+                        worker["service"]
+                    ),
+                    hookenv.ERROR,
+                )
+                pending_restarts.update(worker["name"] for worker in workers[index + 1:])
+                healthy = False
+                break
+        self.kv.set("pending_restarts", sorted(pending_restarts))
+        if restart_main:
+            host.service("restart", self.synapse_service)
+            healthy = self.wait_for_health(self.admin_api_port) and healthy
+        return healthy
+
+    def has_pending_restarts(self):
+        """Return True if workers skipped by a failed rolling restart are waiting to be restarted."""
+        return bool(self.kv.get("pending_restarts"))
+
+    def get_synapse_services(self):
+        """Return the services of synapse and its workers, the main process runs only on the main unit."""
+        services = [self.synapse_service] if self.is_main_unit() else []
+        return services + [worker["service"] for worker in self.get_workers()]
+
+    def reload_synapse(self):
+        """Send SIGHUP to running synapse processes, reloading their log and cache configuration."""
+        for service in self.get_synapse_services():
+            if host.service_running(service):
+                check_call(
+                    ["systemctl", "kill", "--signal=SIGHUP", "--kill-who=main", service]
+                )
+        return True
+
+    def load_synapse_config(self):
+        """Return the rendered synapse configuration, or an empty dict if it is not rendered."""
+        if not path.exists(self.synapse_config):
+            return {}
+        with open(self.synapse_config) as config_file:
+            return yaml.safe_load(config_file) or {}
+
+    def get_changed_keys(self, previous, current, prefix=""):
+        """Return the dotted keys whose values differ between two configurations."""
+        changed_keys = []
+        for key in sorted(set(previous) | set(current)):
+            previous_value = previous.get(key)
+            current_value = current.get(key)
+            if previous_value == current_value:
+                continue
+            if isinstance(previous_value, dict) and isinstance(current_value, dict):
+                changed_keys.extend(
+                    self.get_changed_keys(
+                        previous_value, current_value, "{}{}.".format(prefix, key)
+                    )
+                )
+            else:
+                changed_keys.append("{}{}".format(prefix, key))
+        return changed_keys
+
+    def get_change_action(self, key):
+        """Return how a change to the dotted synapse config key is applied, None for a full restart."""
+        while key:
+            if key in self.synapse_change_actions:
+                return self.synapse_change_actions[key]
+            key = key.rpartition(".")[0]
+        return None
+
+    def apply_synapse_config_changes(self, previous, current, changed_workers=()):
+        """
+        Apply a change of synapse configuration with the least disruptive action.
+
+        Reloads when every change can be applied by SIGHUP, otherwise restarts only the
+        main process and the workers serving affected resources where changes allow.
+        Workers whose own configuration changed, or whose restart is pending from an
+        earlier rolling restart, are restarted in the same rolling restart, so no worker
+        is restarted twice.
+        """
+        actions = set()
+        for key in self.get_changed_keys(previous, current):
+            action = self.get_change_action(key)
+            actions.update(action if isinstance(action, tuple) else (action,))
+        hookenv.log("Applying synapse config changes via {}".format(actions), hookenv.DEBUG)
+        if None in actions:
+            return self.restart_synapse()
+        if "reload" in actions:
+            self.reload_synapse()
+        actions.discard("reload")
+        changed_names = set(worker["name"] for worker in changed_workers)
+        changed_names.update(self.kv.get("pending_restarts", []))
+        workers = [
+            worker
+            for worker in self.get_workers()
+            if worker["name"] in changed_names
+            or worker["type"] in actions
+            or actions.intersection(worker["resources"])
+        ]
+        if not actions and not workers:
+            return True
+        return self.rolling_restart(workers, restart_main=bool(actions) and self.is_main_unit())
 
     def restart(self):
         """Restart services."""
@@ -221,8 +1360,16 @@ class MatrixHelper:
         host.service("enable", service)
         return host.service_running(service)
 
+    def stop_synapse(self):
+        """Stop and disable the main synapse process."""
+        host.service("stop", self.synapse_service)
+        host.service("disable", self.synapse_service)
+        return True
+
     def start_synapse(self):
-        """Start and enable synapse."""
+        """Start and enable synapse on the main unit, stopping it on worker-only units."""
+        if not self.is_main_unit():
+            return self.stop_synapse()
         synapse_running = self.start_service(self.synapse_service)
         return synapse_running
 
@@ -231,22 +1378,107 @@ class MatrixHelper:
         ircd_running = self.start_service(self.matrix_ircd_service)
         return ircd_running
 
+    def start_workers(self):
+        """Start and enable all configured synapse workers."""
+        workers_running = True
+        for worker in self.get_workers():
+            if not self.start_service(worker["service"]):
+                hookenv.log(
+                    "Worker {} is not running".format(worker["name"]), hookenv.WARNING
+                )
+                workers_running = False
+        return workers_running
+
     def start_services(self):
         """Configure and start services."""
         ircd_result = True
         synapse_result = self.start_synapse()
+        workers_result = self.start_workers()
         if self.charm_config.get("enable-ircd"):
             ircd_result = self.start_ircd()
-        return synapse_result and ircd_result
+        return synapse_result and workers_result and ircd_result
+
+    def resolve(self, name, resolver):
+        """
+        Return the result of a name resolution, performed at most once per hook.
+
+        Successful results are persisted in the KV store, and are used for up to
+        resolution_ttl seconds when resolution fails, such as when DNS is down.
+        """
+        if name in self._resolved:
+            return self._resolved[name]
+        kv_key = "resolved_{}".format(name)
+        try:
+            value = resolver()
+            self.kv.set(kv_key, {"value": value, "time": time.time()})
+        except OSError as e:
+            cached = self.kv.get(kv_key)
+            if not cached or time.time() - cached["time"] > self.resolution_ttl:
+                raise
+            hookenv.log(
+                "Unable to resolve {}, using previously resolved {}: {}".format(
+                    name, cached["value"], e
+                ),
+                hookenv.WARNING,
+            )
+            value = cached["value"]
+        self._resolved[name] = value
+        return value
+
+    def lookup_fqdn(self):
+        """
+        Return the FQDN of the unit, raising OSError when it can not be resolved.
+
+        socket.getfqdn returns the bare hostname rather than raising when the
+        lookup fails, so a name without a domain is treated as a failure.
+        """
+        fqdn = socket.getfqdn()
+        if "." not in fqdn:
+            raise OSError("unable to resolve the FQDN of {}".format(fqdn))
+        return fqdn
+
+    def get_fqdn(self):
+        """
+        Return the FQDN of the unit.
+
+        The bare hostname is used, without being persisted as a resolved value,
+        when the FQDN has not been resolved within the TTL.
+        """
+        try:
+            return self.resolve("fqdn", self.lookup_fqdn)
+        except OSError as e:
+            hookenv.log("Using the hostname as the FQDN: {}".format(e), hookenv.WARNING)
+            return socket.gethostname()
+
+    def get_internal_ip(self):
+        """Return the IP address the FQDN of the unit resolves to."""
+        fqdn = self.get_fqdn()
+        return self.resolve("ip", lambda: socket.gethostbyname(fqdn))
 
     def get_server_name(self):
-        """Return the configured server name."""
+        """
+        Return the configured server name, or the FQDN of the leader when not configured.
+
+        The leader shares its FQDN so every unit presents the same server name,
+        returning None on other units until it has been shared. The FQDN is only
+        shared once resolved, never the hostname fallback, as the server name can
+        not be changed later, returning None until it resolves.
+        """
         configured_value = self.charm_config["server-name"]
         if configured_value:
             return configured_value
-        else:
-            fqdn = socket.getfqdn()
-            return fqdn
+        server_name = self.leader_get("server-name")
+        if not server_name and self.is_leader():
+            try:
+                server_name = self.resolve("fqdn", self.lookup_fqdn)
+            except OSError as e:
+                hookenv.log(
+                    "Not sharing a server name until the FQDN resolves: {}".format(e),
+                    hookenv.WARNING,
+                )
+                return None
+            self.leader_set({"server-name": server_name})
+        return server_name
 
     def get_external_domain(self):
         """Return the external domain name if configured, otherwise, return None."""
@@ -270,21 +1502,13 @@ class MatrixHelper:
 
     def get_internal_host(self):
         """Get the host to use when configuring synapse to talk to IRCd and reverse proxies."""
-        prefer_internal_ip = self.charm_config.get("prefer-internal-ip")
-        fqdn = socket.getfqdn()
-        ip = socket.gethostbyname(fqdn)
-        if prefer_internal_ip:
-            return ip
-        return fqdn
+        if self.charm_config.get("prefer-internal-ip"):
+            return self.get_internal_ip()
+        return self.get_fqdn()
 
     def get_internal_url(self):
         """Get the URL to use when configuring IRCd to talk to synapse."""
-        prefer_internal_ip = self.charm_config.get("prefer-internal-ip")
-        fqdn = socket.getfqdn()
-        ip = socket.gethostbyname(fqdn)
-        if prefer_internal_ip:
-            return "http://{}:8008".format(ip)
-        return "http://{}:8008".format(fqdn)
+        return "http://{}:8008".format(self.get_internal_host())
 
     def get_irc_port(self):
         """Get the correct IRC port based on TLS state."""
@@ -324,12 +1548,444 @@ class MatrixHelper:
         blacklist = self.charm_config["federation-ip-range-blacklist"]
         return list(filter(None, blacklist.split(",")))
 
+    def get_worker_counts(self, main=None):
+        """
+        Return a list of worker types, instance counts and resources from the workers and worker count config.
+
+        Units other than the main unit run only the stateless worker types, which can be
+        scaled across units, defaulting to the role of this unit.
+        """
+        if main is None:
+            main = self.is_main_unit()
+        if not main:
+            return [
+                worker_count
+                for worker_count in self.get_worker_counts(main=True)
+                if worker_count[0] in self.synapse_stateless_worker_types
+            ]
+        worker_counts = []
+        for entry in filter(None, self.charm_config.get("workers", "").split(",")):
+            worker_type, _, count = entry.partition("=")
+            worker_type = worker_type.strip()
+            if worker_type not in self.synapse_worker_resources:
+                hookenv.log(
+                    "Ignoring unsupported worker type {}".format(worker_type),
+                    hookenv.WARNING,
+                )
+                continue
+            try:
+                count = int(count or 1)
+            except ValueError:
+                hookenv.log(
+                    "Ignoring invalid worker count for {}: {}".format(worker_type, count),
+                    hookenv.WARNING,
+                )
+                continue
+            worker_counts.append((worker_type, count, self.synapse_worker_resources[worker_type]))
+        for worker_type, (option, resources) in self.synapse_worker_count_options.items():
+            count = int(self.charm_config.get(option) or 0)
+            if count > 0:
+                worker_counts.append((worker_type, count, resources))
+        for stream, count in self.get_stream_writer_counts():
+            worker_counts.append(("{}_writer".format(stream), count, ["client"]))
+        return worker_counts
+
+    def get_stream_writer_counts(self):
+        """Return a list of streams and writer counts from the comma separated stream-writers config."""
+        stream_writer_counts = []
+        for entry in filter(None, self.charm_config.get("stream-writers", "").split(",")):
+            stream, _, count = entry.partition("=")
+            stream = stream.strip()
+            if stream not in self.synapse_stream_writer_limits:
+                hookenv.log(
+                    "Ignoring unsupported stream writer {}".format(stream), hookenv.WARNING
+                )
+                continue
+            try:
+                count = int(count or 1)
+            except ValueError:
+                hookenv.log(
+                    "Ignoring invalid writer count for {}: {}".format(stream, count),
+                    hookenv.WARNING,
+                )
+                continue
+            limit = self.synapse_stream_writer_limits[stream]
+            if limit is not None and count > limit:
+                hookenv.log(
+                    "Synapse supports at most {} {} writer(s)".format(limit, stream),
+                    hookenv.WARNING,
+                )
+                count = limit
+            stream_writer_counts.append((stream, count))
+        return stream_writer_counts
+
+    def get_stream_writers(self):
+        """Return a dict of streams to the names of the workers writing them."""
+        stream_writers = {}
+        event_persisters = self.get_workers_of_type("event_persister")
+        if event_persisters:
+            stream_writers["events"] = event_persisters
+        for stream, _ in self.get_stream_writer_counts():
+            stream_writers[stream] = self.get_workers_of_type("{}_writer".format(stream))
+        return stream_writers
+
+    def get_instance_map(self):
+        """Return a dict of worker names to replication ports for workers of the main unit serving replication."""
+        return {
+            worker["name"]: worker["replication_port"]
+            for worker in self.get_workers(main=True)
+            if worker["replication_port"]
+        }
+
+    def get_workers_of_type(self, worker_type):
+        """Return the names of workers of the provided type, which run on the main unit."""
+        return [
+            worker["name"]
+            for worker in self.get_workers(main=True)
+            if worker["type"] == worker_type
+        ]
+
+    def get_worker_of_type(self, worker_type):
+        """Return the name of the first worker of the provided type, None if there is none."""
+        workers = self.get_workers_of_type(worker_type)
+        return workers[0] if workers else None
+
+    def get_workers(self, main=None):
+        """
+        Return the list of worker instances parsed from the workers and worker count config.
+
+        The workers config is a comma separated list of worker types and
+        instance counts, such as synchrotron=4,federation_reader=2. Each
+        instance is allocated a listener port, configuration file and service.
+        Workers from count options, such as federation-senders, follow them.
+        Worker names on units other than the main unit carry the unit number,
+        as worker names must be unique across the homeserver.
+        """
+        if main is None:
+            main = self.is_main_unit()
+        suffix = "" if main else "-{}".format(hookenv.local_unit().split("/")[-1])
+        workers = []
+        port = self.synapse_worker_base_port
+        metrics_port = self.synapse_worker_metrics_base_port
+        replication_port = self.synapse_worker_replication_base_port
+        for worker_type, count, resources in self.get_worker_counts(main):
+            writes_stream = worker_type == "event_persister" or worker_type.endswith("_writer")
+            for index in range(1, count + 1):
+                name = "{}{}{}".format(worker_type, index, suffix)
+                workers.append(
+                    {
+                        "name": name,
+                        "type": worker_type,
+                        "port": port,
+                        "metrics_port": metrics_port,
+                        "replication_port": replication_port if writes_stream else None,
+                        "resources": resources,
+                        "config": path.join(
+                            self.synapse_worker_conf_dir, "{}.yaml".format(name)
+                        ),
+                        "service": "{}{}".format(
+                            self.synapse_worker_service_prefix, name
+                        ),
+                    }
+                )
+                port += 1
+                metrics_port += 1
+                if writes_stream:
+                    replication_port += 1
+        return workers
+
+    def get_media_workers(self):
+        """Return the media repository workers, which serve media in place of the main process."""
+        return [worker for worker in self.get_workers() if worker["type"] == "media_repository"]
+
+    def save_storage_location(self, name, storage_id=None):
+        """Save the mount location of attached Juju storage in the key value store."""
+        location = hookenv.storage_get("location", storage_id)
+        hookenv.log("Storage {} attached at {}".format(name, location), hookenv.DEBUG)
+        self.kv.set("storage_{}".format(name), location)
+
+    def remove_storage_location(self, name):
+        """Remove the location of detaching Juju storage from the key value store."""
+        self.kv.unset("storage_{}".format(name))
+
+    def get_media_store_path(self):
+        """Return the path media is stored in, from config, the media storage or the synapse config dir."""
+        return (
+            self.charm_config.get("media-store-path")
+            or self.kv.get("storage_media")
+            or path.join(self.synapse_conf_dir, "media_store")
+        )
+
+    def get_uploads_path(self):
+        """Return the path for uploads in progress, on tmpfs, the uploads storage or the synapse config dir."""
+        if self.charm_config.get("uploads-tmpfs-size"):
+            return self.uploads_tmpfs_path
+        return self.kv.get("storage_uploads") or path.join(self.synapse_conf_dir, "uploads")
+
+    def configure_uploads_tmpfs(self):
+        """Mount or unmount the uploads tmpfs to match the configured size."""
+        size = self.charm_config.get("uploads-tmpfs-size")
+        mounted = any(mount[0] == self.uploads_tmpfs_path for mount in host.mounts())
+        if mounted and size != self.kv.get("uploads_tmpfs_size"):
+            hookenv.log("Unmounting uploads tmpfs", hookenv.DEBUG)
+            host.umount(self.uploads_tmpfs_path, persist=True)
+            mounted = False
+        if size and not mounted:
+            hookenv.log("Mounting {} uploads tmpfs".format(size), hookenv.DEBUG)
+            host.mkdir(self.uploads_tmpfs_path, perms=0o700)
+            host.mount(
+                "tmpfs",
+                self.uploads_tmpfs_path,
+                options="size={},mode=0700".format(size),
+                persist=True,
+                filesystem="tmpfs",
+            )
+        self.kv.set("uploads_tmpfs_size", size)
+        return True
+
+    def get_worker_unit_file(self, worker_name):
+        """Return the path of the systemd unit file for the named worker."""
+        return path.join(
+            self.synapse_worker_service_dir,
+            "{}{}.service".format(self.synapse_worker_service_prefix, worker_name),
+        )
+
+    def reload_systemd(self):
+        """Reload systemd so added, changed or removed worker units are picked up."""
+        check_call(["systemctl", "daemon-reload"])
+
+    def remove_worker(self, worker_name):
+        """Stop, disable and remove the service and configuration of the named worker."""
+        hookenv.log("Removing synapse worker {}".format(worker_name), hookenv.DEBUG)
+        service = "{}{}".format(self.synapse_worker_service_prefix, worker_name)
+        host.service("stop", service)
+        host.service("disable", service)
+        self.kv.set(
+            "pending_restarts",
+            [name for name in self.kv.get("pending_restarts", []) if name != worker_name],
+        )
+        self.remove_rendered_files(
+            self.get_worker_unit_file(worker_name),
+            path.join(self.synapse_worker_conf_dir, "{}.yaml".format(worker_name)),
+        )
+
+    def remove_rendered_files(self, *stale_files):
+        """Remove rendered files along with their render hashes."""
+        render_hashes = self.kv.get("render_hashes", {})
+        for stale_file in stale_files:
+            if path.exists(stale_file):
+                os.remove(stale_file)
+            render_hashes.pop(stale_file, None)
+        self.kv.set("render_hashes", render_hashes)
+
+    def get_render_hash(self, source, context):
+        """Return a hash of a template source and the context it is rendered with."""
+        digest = hashlib.sha256()
+        with open(path.join(hookenv.charm_dir(), "templates", source), "rb") as template:
+            digest.update(template.read())
+        digest.update(json.dumps(context, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def render_template(self, source, target, context, perms=0o444):
+        """
+        Render a template to target, returning True if the target file changed.
+
+        The hash of the template and context is kept in the KV store, so rendering
+        and checking the target for changes is skipped when neither has changed.
+        """
+        render_hashes = self.kv.get("render_hashes", {})
+        render_hash = self.get_render_hash(source, context)
+        if render_hashes.get(str(target)) == render_hash and path.exists(target):
+            hookenv.log("Skipping render of unchanged {}".format(target), hookenv.DEBUG)
+            return False
+        templating.render(source, target, context, perms=perms)
+        render_hashes[str(target)] = render_hash
+        self.kv.set("render_hashes", render_hashes)
+        return any_file_changed([target])
+
+    def render_worker_configs(self):
+        """Render configuration and service units for synapse workers, removing stale workers."""
+        workers = self.get_workers()
+        changed_workers = []
+        units_changed = False
+        for worker in workers:
+            hookenv.log(
+                "Rendering worker configuration to {}".format(worker["config"]),
+                hookenv.DEBUG,
+            )
+            worker_config_changed = self.render_template(
+                "worker.yaml.j2",
+                worker["config"],
+                {
+                    "worker_name": worker["name"],
+                    "worker_port": worker["port"],
+                    "worker_resources": worker["resources"],
+                    "worker_replication_port": worker["replication_port"],
+                    "log_config": self.synapse_log_config,
+                    "enable_metrics": self.charm_config.get("enable-metrics"),
+                    "metrics_port": worker["metrics_port"],
+                    "replication_bind": self.get_replication_bind(),
+                    "redis": self.get_redis_config(),
+                },
+            )
+            unit_file = self.get_worker_unit_file(worker["name"])
+            if self.render_template(
+                "matrix-synapse-worker.service.j2",
+                unit_file,
+                {
+                    "worker_name": worker["name"],
+                    "synapse_config": self.synapse_config,
+                    "worker_config": worker["config"],
+                    "synapse_service": self.synapse_service if self.is_main_unit() else None,
+                },
+                perms=0o644,
+            ):
+                units_changed = True
+            if worker_config_changed:
+                changed_workers.append(worker)
+
+        worker_names = [worker["name"] for worker in workers]
+        for stale_worker in self.kv.get("synapse_workers", []):
+            if stale_worker not in worker_names:
+                self.remove_worker(stale_worker)
+                units_changed = True
+        self.kv.set("synapse_workers", worker_names)
+
+        if units_changed:
+            self.reload_systemd()
+        self._changed_workers = changed_workers
+        return True
+
+    def get_per_cache_factors(self):
+        """Return dict of cache names to cache factors based on comma separated charm config."""
+        per_cache_factors = {}
+        for entry in filter(None, self.charm_config.get("per-cache-factors", "").split(",")):
+            cache_name, _, factor = entry.partition("=")
+            try:
+                per_cache_factors[cache_name.strip()] = float(factor)
+            except ValueError:
+                hookenv.log(
+                    "Ignoring invalid cache factor for {}: {}".format(cache_name, factor),
+                    hookenv.WARNING,
+                )
+        return per_cache_factors
+
+    def get_rate_limits(self):
+        """
+        Return the nested rate limit settings from the rate-limit-preset and rate-limit-overrides config.
+
+        Overrides are a comma separated list of dotted setting names and values, such as
+        rc_message.per_second=1,rc_joins.local.burst_count=20. Raises ValueError if the
+        preset, a setting name or a value is invalid.
+        """
+        preset = self.charm_config.get("rate-limit-preset")
+        if preset and preset not in self.rate_limit_presets:
+            raise ValueError("unknown rate limit preset {}".format(preset))
+        rate_limits = dict(self.rate_limit_presets.get(preset, {}))
+        for entry in filter(None, self.charm_config.get("rate-limit-overrides", "").split(",")):
+            key, _, value = entry.partition("=")
+            key = key.strip()
+            setting, _, field = key.rpartition(".")
+            if field not in self.rate_limit_fields.get(setting, ()):
+                raise ValueError("unknown rate limit setting {}".format(key))
+            try:
+                number = float(value)
+            except ValueError:
+                raise ValueError("invalid value for rate limit {}: {}".format(key, value))
+            if number < 0:
+                raise ValueError("rate limit {} must not be negative".format(key))
+            rate_limits[key] = int(number) if number.is_integer() else number
+        nested = {}
+        for key, value in rate_limits.items():
+            parts = key.split(".")
+            section = nested
+            for part in parts[:-1]:
+                section = section.setdefault(part, {})
+            section[parts[-1]] = value
+        return nested
+
+    def get_log_level(self):
+        """Return the configured log level of synapse and its workers, raising ValueError if it is invalid."""
+        log_level = (self.charm_config.get("log-level") or "INFO").upper()
+        if log_level not in self.log_levels:
+            raise ValueError(
+                "invalid log-level {}, expected one of {}".format(log_level, ", ".join(self.log_levels))
+            )
+        return log_level
+
+    def get_physical_memory(self):
+        """Return the physical memory of the unit in megabytes."""
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+
+    def get_cache_factor(self):
+        """
+        Return the global cache factor, from config or sized from physical memory when autotuning.
+
+        When cache autotuning is enabled, the configured share of physical memory is
+        split between the main process and any workers, each given the cache factor
+        that share of memory allows, and no less than the minimum cache factor.
+        """
+        if not self.charm_config.get("cache-autotuning"):
+            return self.charm_config["cache-factor"]
+        processes = 1 + len(self.get_workers())
+        process_memory = self.get_physical_memory() * self.cache_target_memory_share / processes
+        return max(self.cache_min_factor, round(process_memory / self.cache_memory_per_factor, 1))
+
+    def get_metrics_targets(self):
+        """Return a list of prometheus scrape targets for the main synapse process and each worker."""
+        if not self.charm_config.get("enable-metrics"):
+            return []
+        internal_host = self.get_internal_host()
+        targets = []
+        if self.is_main_unit():
+            targets.append(
+                {
+                    "targets": ["{}:{}".format(internal_host, self.synapse_metrics_port)],
+                    "labels": {"unit": hookenv.local_unit(), "worker": "main"},
+                }
+            )
+        for worker in self.get_workers():
+            targets.append(
+                {
+                    "targets": ["{}:{}".format(internal_host, worker["metrics_port"])],
+                    "labels": {"unit": hookenv.local_unit(), "worker": worker["name"]},
+                }
+            )
+        return targets
+
+    def publish_metrics_targets(self):
+        """Publish the scrape job for all synapse processes on each prometheus relation."""
+        job = {
+            "job_name": "matrix-synapse",
+            "job_data": {
+                "metrics_path": self.synapse_metrics_path,
+                "static_configs": self.get_metrics_targets(),
+            },
+        }
+        for relation_id in hookenv.relation_ids("prometheus"):
+            hookenv.log(
+                "Publishing metrics targets on {}".format(relation_id), hookenv.DEBUG
+            )
+            hookenv.relation_set(
+                relation_id, {"request_matrix-synapse": json.dumps(job, sort_keys=True)}
+            )
+
     def remove_proxy_config(self):
         """Clean up proxy config and set exernal port back to 8008."""
         self.external_port = 8008
 
     def configure_proxy(self, proxy):
-        """Configure Synapse for operation behind a reverse proxy."""
+        """
+        Configure Synapse for operation behind a reverse proxy.
+
+        The main unit publishes backends for its main process and the workers of every
+        unit in the peer relation, with health checks so the proxy only sends requests
+        to healthy processes. Other units publish no backends of their own.
+        """
+        if self.get_unit_role() != "main":
+            hookenv.log("Leaving reverse proxy configuration to the main unit", hookenv.DEBUG)
+            proxy.configure([])
+            return
         server_name = self.get_external_domain()
         tls_enabled = self.get_tls()
         ircd_enabled = self.charm_config.get("enable-ircd")
@@ -347,6 +2003,8 @@ class MatrixHelper:
                 "internal_host": self.get_internal_host(),
                 "internal_port": 8008,
                 "subdomain": server_name,
+                "check": True,
+                "check_path": self.synapse_health_path,
             },
         ]
 
@@ -357,9 +2015,12 @@ class MatrixHelper:
                     "external_port": 8448,
                     "internal_host": self.get_internal_host(),
                     "internal_port": 8448,
+                    "check": True,
                 }
             )
 
+        proxy_config.extend(self.get_worker_proxy_config(server_name))
+
         if ircd_enabled:
             proxy_config.append(
                 {
@@ -367,11 +2028,195 @@ class MatrixHelper:
                     "external_port": self.get_irc_port(),
                     "internal_host": self.get_internal_host(),
                     "internal_port": self.irc_internal_port,
+                    "check": True,
                 }
             )
 
         proxy.configure(proxy_config)
 
+    def get_proxy_features(self):
+        """
+        Return the optional reverseproxy settings the related proxies advertise support for.
+
+        Proxies list the settings they support beyond urlbase routing, such as urlregex
+        and balance, as a comma separated features value in their relation data.
+        Settings are only used when every related proxy unit supports them.
+        """
+        features = None
+        for relation_id in hookenv.relation_ids("reverseproxy"):
+            for unit in hookenv.related_units(relation_id):
+                data = hookenv.relation_get(rid=relation_id, unit=unit) or {}
+                unit_features = set(filter(None, data.get("features", "").split(",")))
+                features = unit_features if features is None else features & unit_features
+        return features or set()
+
+    def get_unroutable_worker_types(self):
+        """Return the configured worker types whose routes all need urlregex, which the reverse proxy lacks."""
+        if "urlregex" in self.get_proxy_features():
+            return []
+        return sorted(
+            set(
+                worker_type
+                for worker_type, _, _ in self.get_worker_counts(main=True)
+                if self.synapse_worker_routes.get(worker_type)
+                and all("urlregex" in route for route in self.synapse_worker_routes[worker_type])
+            )
+        )
+
+    def get_active_status(self):
+        """Return the active status message, naming any workers the reverse proxy can not route requests to."""
+        unroutable = self.get_unroutable_worker_types()
+        if not unroutable:
+            return self.HEALTHY
+        message = "reverse proxy can not route to {} workers without urlregex".format(", ".join(unroutable))
+        hookenv.log("Workers will receive no requests, {}".format(message), hookenv.WARNING)
+        return "{}, {}".format(self.HEALTHY, message)
+
+    def get_worker_proxy_config(self, server_name):
+        """
+        Return reverse proxy configuration routing URL paths to the workers serving them.
+
+        Each route of a worker type is a backend shared by the instances of that type on
+        every unit, grouped by group_id, with requests for other paths left to the main process.
+        Routes matched by urlregex are only published to proxies which support it, as a
+        proxy ignoring urlregex would send every request to the worker.
+        """
+        features = self.get_proxy_features()
+        proxy_config = []
+        for unit in self.get_peer_units():
+            for worker in unit["workers"]:
+                for index, route in enumerate(self.synapse_worker_routes.get(worker["type"], [])):
+                    if "urlregex" in route and "urlregex" not in features:
+                        continue
+                    worker_config = {
+                        "mode": "http",
+                        "external_port": self.external_port,
+                        "internal_host": unit["address"],
+                        "internal_port": worker["port"],
+                        "subdomain": server_name,
+                        "group_id": "{}-{}-{}".format(server_name, worker["type"], index),
+                        "check": True,
+                        "check_path": self.synapse_health_path,
+                    }
+                    worker_config.update(route)
+                    if "balance" not in features:
+                        worker_config.pop("balance", None)
+                    proxy_config.append(worker_config)
+        return proxy_config
+
+    def is_main_unit(self):
+        """
+        Return True if this unit runs the main synapse process, which is run by the leader.
+
+        The main unit is recorded in leader settings. After a change of leadership the
+        new leader only takes over once the previous main unit reports its main process
+        stopped on the peer relation, or has left it, so two main processes never share
+        the database. Requesting the handover in leader settings wakes the previous
+        main unit to stop its main process. The role is determined once per hook.
+        """
+        if "main" not in self._leadership:
+            self._leadership["main"] = self.take_main_unit() if self.is_leader() else False
+        return self._leadership["main"]
+
+    def take_main_unit(self):
+        """Return True if the leader may run the main synapse process, recording it as the main unit."""
+        local_unit = hookenv.local_unit()
+        main_unit = self.leader_get("main-unit")
+        if main_unit == local_unit:
+            return True
+        if main_unit and self.get_peer_main_running(main_unit):
+            if self.leader_get("main-handover") != local_unit:
+                hookenv.log(
+                    "Waiting for {} to stop the main process".format(main_unit), hookenv.INFO
+                )
+                self.leader_set({"main-handover": local_unit})
+            return False
+        hookenv.log("Taking over the main process from {}".format(main_unit), hookenv.INFO)
+        self.leader_set({"main-unit": local_unit})
+        return True
+
+    def get_peer_main_running(self, unit):
+        """Return True if the peer unit reports running the main synapse process."""
+        for relation_id in hookenv.relation_ids(self.peer_relation):
+            if unit in hookenv.related_units(relation_id):
+                data = hookenv.relation_get(rid=relation_id, unit=unit) or {}
+                return data.get("main-running") == "true"
+        return False
+
+    def get_unit_role(self):
+        """Return the role of this unit, the leader runs the main synapse process."""
+        return "main" if self.is_main_unit() else "worker"
+
+    def has_peers(self):
+        """Return True if other units of the application are present on the peer relation."""
+        return any(
+            hookenv.related_units(relation_id)
+            for relation_id in hookenv.relation_ids(self.peer_relation)
+        )
+
+    def get_replication_host(self):
+        """
+        Return the address workers reach the replication listeners of the main unit on.
+
+        The leader shares its address with the other units, on a single unit
+        deployment replication stays on the loopback interface.
+        """
+        if not self.has_peers():
+            return "127.0.0.1"
+        if self.is_main_unit():
+            main_address = self.get_internal_host()
+            if self.leader_get("main-address") != main_address:
+                self.leader_set({"main-address": main_address})
+            return main_address
+        return self.leader_get("main-address")
+
+    def get_replication_bind(self):
+        """Return the address replication listeners bind to, reachable by peer units when present."""
+        return "::" if self.has_peers() else "127.0.0.1"
+
+    def get_peer_info(self):
+        """Return the address, role, main process state and workers of this unit, as shared with peers."""
+        return {
+            "address": self.get_internal_host(),
+            "role": self.get_unit_role(),
+            "main_running": host.service_running(self.synapse_service),
+            "workers": [
+                {"type": worker["type"], "port": worker["port"]} for worker in self.get_workers()
+            ],
+        }
+
+    def publish_peer_info(self):
+        """Share the address, role and workers of this unit on the peer relation."""
+        peer_info = self.get_peer_info()
+        for relation_id in hookenv.relation_ids(self.peer_relation):
+            hookenv.relation_set(
+                relation_id,
+                {
+                    "address": peer_info["address"],
+                    "role": peer_info["role"],
+                    "main-running": "true" if peer_info["main_running"] else "false",
+                    "workers": json.dumps(peer_info["workers"]),
+                },
+            )
+
+    def get_peer_units(self):
+        """Return the address, role and workers of this unit followed by each peer unit which has shared them."""
+        units = [dict(self.get_peer_info(), unit=hookenv.local_unit())]
+        for relation_id in hookenv.relation_ids(self.peer_relation):
+            for unit in hookenv.related_units(relation_id):
+                data = hookenv.relation_get(rid=relation_id, unit=unit) or {}
+                if not data.get("address"):
+                    continue
+                units.append(
+                    {
+                        "unit": unit,
+                        "address": data["address"],
+                        "role": data.get("role", "worker"),
+                        "workers": json.loads(data.get("workers") or "[]"),
+                    }
+                )
+        return units
+
     def pgsql_configured(self):
         """Determine if we have all requried DB configuration present."""
         if (
@@ -395,11 +2240,13 @@ class MatrixHelper:
 
     def remove_pgsql_conf(self):
         """Remove the pgsql configuration from the unit KV store."""
+        self.close_pgsql_pool()
         self.kv.unset("pgsql_host")
         self.kv.unset("pgsql_port")
         self.kv.unset("pgsql_db")
         self.kv.unset("pgsql_user")
         self.kv.unset("pgsql_pass")
+        self.kv.unset("pgsql_max_connections")
         self.kv.flush()
 
     def save_pgsql_conf(self, db):
@@ -410,34 +2257,208 @@ class MatrixHelper:
         )
         if db:
             hookenv.log("Saving related PostgreSQL database config", hookenv.DEBUG)
+            self.close_pgsql_pool()
             self.kv.set("pgsql_host", db.master.host)
             self.kv.set("pgsql_port", db.master.port)
             self.kv.set("pgsql_db", db.master.dbname)
             self.kv.set("pgsql_user", db.master.user)
             self.kv.set("pgsql_pass", db.master.password)
+            self.kv.unset("pgsql_max_connections")
+            self.kv.flush()
+
+    def remove_redis_conf(self):
+        """Remove the related Redis configuration from the unit KV store."""
+        self.kv.unset("redis_host")
+        self.kv.unset("redis_port")
+        self.kv.unset("redis_pass")
+        self.kv.flush()
+
+    def save_redis_conf(self, redis):
+        """Configure Matrix with knowledge of a related Redis endpoint."""
+        hookenv.log(
+            "Checking related Redis information before saving Redis configuration",
+            hookenv.DEBUG,
+        )
+        redis_data = redis.relation_data() if redis else None
+        if redis_data:
+            hookenv.log("Saving related Redis config", hookenv.DEBUG)
+            self.kv.set("redis_host", redis_data[0].get("host"))
+            self.kv.set("redis_port", redis_data[0].get("port"))
+            self.kv.set("redis_pass", redis_data[0].get("password"))
             self.kv.flush()
 
+    def redis_related(self):
+        """Determine if a related Redis endpoint is present in the KV store."""
+        return bool(self.kv.get("redis_host") and self.kv.get("redis_port"))
+
+    def get_redis_config(self):
+        """
+        Return the Redis connection details to use for replication.
+
+        A related Redis is preferred. When workers are configured without a
+        related Redis, the Redis server local to the main unit is used. Returns
+        None if replication via Redis is not required or not yet available.
+        """
+        if self.redis_related():
+            return {
+                "host": self.kv.get("redis_host"),
+                "port": self.kv.get("redis_port"),
+                "password": self.kv.get("redis_pass"),
+            }
+        if self.is_main_unit() and self.get_workers():
+            return {
+                "host": self.redis_local_host,
+                "port": self.redis_local_port,
+                "password": None,
+            }
+        return None
+
+    def configure_local_redis(self):
+        """Install and run a local Redis server when workers need one and none is related."""
+        local_redis_required = (
+            self.is_main_unit() and bool(self.get_workers()) and not self.redis_related()
+        )
+        if local_redis_required:
+            from charmhelpers import fetch
+
+            if fetch.filter_installed_packages([self.redis_package]):
+                hookenv.log("Installing local Redis server", hookenv.DEBUG)
+                fetch.apt_install([self.redis_package], fatal=True)
+            self.kv.set("local_redis", True)
+            return self.start_service(self.redis_service)
+        if self.kv.get("local_redis"):
+            hookenv.log("Stopping local Redis server", hookenv.DEBUG)
+            host.service("stop", self.redis_service)
+            host.service("disable", self.redis_service)
+            self.kv.set("local_redis", False)
+        return True
+
+    def get_pgsql_max_connections(self):
+        """
+        Return the number of connections available to non-superusers on the related PostgreSQL.
+
+        The value is queried once per related database and cached in the KV store,
+        returning None if it can not be determined.
+        """
+        if self.kv.get("pgsql_max_connections"):
+            return self.kv.get("pgsql_max_connections")
+        max_connections = self.pgsql_query(
+            "SELECT current_setting('max_connections')::int "
+            "- current_setting('superuser_reserved_connections')::int;"
+        )
+        if not isinstance(max_connections, list) or not max_connections:
+            hookenv.log(
+                "Unable to query max_connections from PostgreSQL: {}".format(
+                    max_connections
+                ),
+                hookenv.WARNING,
+            )
+            return None
+        self.kv.set("pgsql_max_connections", max_connections[0][0])
+        return max_connections[0][0]
+
+    def get_db_pool_size(self):
+        """
+        Return the minimum and maximum database connection pool size for each synapse process.
+
+        In auto mode the connections available on the related PostgreSQL, less a
+        reserve, are split evenly between the main process and the workers of every
+        unit, as shared on the peer relation. The reserve grows by the connections
+        the charm on each additional unit may hold.
+        """
+        pool_min = self.charm_config.get("db-pool-min")
+        pool_max = self.charm_config.get("db-pool-max")
+        if self.charm_config.get("db-pool-auto"):
+            max_connections = self.get_pgsql_max_connections()
+            if max_connections:
+                units = self.get_peer_units()
+                processes = 1 + sum(len(unit["workers"]) for unit in units)
+                reserved = self.pgsql_reserved_connections + self.pgsql_pool_size * (len(units) - 1)
+                pool_max = max(1, (max_connections - reserved) // processes)
+        return min(pool_min, pool_max), pool_max
+
+    def get_cluster_context(self):
+        """
+        Return the server name, signing key, secrets and replication addresses shared by the units of the homeserver.
+
+        Returns None, setting render_error, until the leader has shared them or while
+        workers of a unit other than the main unit have no related Redis to replicate with.
+        """
+        server_name = self.get_server_name()
+        context = {
+            "server_name": server_name,
+            # The signing key file is named after the server name
+            "signing_key": server_name and self.get_synapse_signing_key(),
+            "registration_shared_secret": self.get_shared_secret(),
+            "worker_replication_secret": self.get_replication_secret(),
+            "replication_host": self.get_replication_host(),
+            "replication_bind": self.get_replication_bind(),
+        }
+        if not server_name and self.is_leader():
+            self.render_error = "Unable to resolve the FQDN to use as server name, set server-name"
+            hookenv.log(self.render_error, hookenv.WARNING)
+            return None
+        if not all(context.values()):
+            self.render_error = "Waiting for the leader to share secrets"
+            hookenv.log(self.render_error, hookenv.DEBUG)
+            return None
+        if self.get_workers() and not self.get_redis_config():
+            self.render_error = "Workers on this unit require a related Redis"
+            hookenv.log(self.render_error, hookenv.WARNING)
+            return None
+        return context
+
     def render_synapse_config(self):
         """Render the configuration for Matrix synapse."""
         hookenv.log(
             "Rendering synapse configuration to {}".format(self.synapse_config),
             hookenv.DEBUG,
         )
+        self.render_error = None
         if self.pgsql_configured():
-            render_result = templating.render(
+            try:
+                rate_limits = self.get_rate_limits()
+            except ValueError as e:
+                self.render_error = "Invalid rate limit config: {}".format(e)
+                hookenv.log(self.render_error, hookenv.ERROR)
+                return False
+            if self.get_stream_writer_counts() and "urlregex" not in self.get_proxy_features():
+                self.render_error = "stream-writers require a reverse proxy with urlregex support"
+                hookenv.log(self.render_error, hookenv.ERROR)
+                return False
+            try:
+                log_level = self.get_log_level()
+            except ValueError as e:
+                self.render_error = str(e)
+                hookenv.log(self.render_error, hookenv.ERROR)
+                return False
+            cluster_context = self.get_cluster_context()
+            if cluster_context is None:
+                return False
+            if self.render_template(
+                "log.yaml.j2",
+                self.synapse_log_config,
+                {"log_level": log_level},
+                perms=0o644,
+            ):
+                self.reload_synapse()
+            db_pool_min, db_pool_max = self.get_db_pool_size()
+            previous_config = self.load_synapse_config()
+            if self.render_template(
                 "homeserver.yaml.j2",
                 self.synapse_config,
                 {
                     "conf_dir": self.synapse_conf_dir,
-                    "signing_key": self.get_synapse_signing_key(),
-                    "registration_shared_secret": self.get_shared_secret(),
+                    "log_config": self.synapse_log_config,
                     "pgsql_configured": self.pgsql_configured(),
                     "pgsql_host": self.kv.get("pgsql_host"),
                     "pgsql_port": self.kv.get("pgsql_port"),
                     "pgsql_db": self.kv.get("pgsql_db"),
                     "pgsql_user": self.kv.get("pgsql_user"),
                     "pgsql_pass": self.kv.get("pgsql_pass"),
-                    "server_name": self.get_server_name(),
+                    "db_pool_min": db_pool_min,
+                    "db_pool_max": db_pool_max,
+                    "db_txn_limit": self.charm_config.get("db-txn-limit"),
                     "public_baseurl": self.get_public_baseurl(),
                     "enable_tls": self.get_tls(),
                     "enable_search": self.charm_config["enable-search"],
@@ -452,6 +2473,7 @@ class MatrixHelper:
                         "require-auth-profile-requests"
                     ],
                     "default_room_version": self.charm_config["default-room-version"],
+                    "bcrypt_rounds": self.charm_config["bcrypt-rounds"],
                     "block_non_admin_invites": not bool(
                         self.charm_config["enable-non-admin-invites"]
                     ),
@@ -464,12 +2486,32 @@ class MatrixHelper:
                     ],
                     "federation_domain_whitelist": self.get_domain_whitelist(),
                     "federation_ip_range_blacklist": self.get_federation_iprange_blacklist(),
+                    "workers": self.get_workers(main=True),
+                    "replication_port": self.synapse_replication_port,
+                    "redis": self.get_redis_config(),
+                    "enable_metrics": self.charm_config.get("enable-metrics"),
+                    "metrics_port": self.synapse_metrics_port,
+                    "cache_factor": self.get_cache_factor(),
+                    "per_cache_factors": self.get_per_cache_factors(),
+                    "rate_limits": rate_limits,
+                    "media_store_path": self.get_media_store_path(),
+                    "uploads_path": self.get_uploads_path(),
+                    "media_workers": self.get_workers_of_type("media_repository"),
+                    "federation_senders": self.get_workers_of_type("federation_sender"),
+                    "pushers": self.get_workers_of_type("pusher"),
+                    "appservice_worker": self.get_worker_of_type("appservice"),
+                    "user_directory_worker": self.get_worker_of_type("user_dir"),
+                    "background_worker": self.get_worker_of_type("background_worker"),
+                    "instance_map": self.get_instance_map(),
+                    "stream_writers": self.get_stream_writers(),
+                    "max_upload_size": self.charm_config.get("max-upload-size"),
+                    "max_image_pixels": self.charm_config.get("max-image-pixels"),
+                    "dynamic_thumbnails": self.charm_config.get("dynamic-thumbnails"),
+                    **cluster_context,
                 },
-            )
-            if render_result:
-                if any_file_changed([self.synapse_config]):
-                    self.restart_synapse()
-                return True
+            ):
+                self._synapse_config_changes = (previous_config, self.load_synapse_config())
+            return True
         return False
 
     def render_ircd_config(self):
@@ -479,27 +2521,44 @@ class MatrixHelper:
             hookenv.DEBUG,
         )
         if self.pgsql_configured():
-            render_result = templating.render(
+            if self.render_template(
                 "matrix-ircd.env.j2",
                 self.matrix_ircd_config,
                 {
                     "home_server": self.get_internal_url(),
                     "bind": "{}:{}".format(self.irc_internal_listen, self.irc_internal_port),
                 },
-            )
-            if render_result:
-                if any_file_changed([self.matrix_ircd_config]):
-                    self.restart_matrix_ircd()
-                return True
+            ):
+                self.restart_matrix_ircd()
+            return True
+        return False
+
+    def apply_rendered_changes(self):
+        """
+        Apply the changes made by rendering the synapse and worker configurations.
+
+        Changes are applied once every configuration and worker unit is rendered, so
+        restarted processes, including new workers, start with the new configuration.
+        """
+        previous, current = self._synapse_config_changes or ({}, {})
+        changed_workers = self._changed_workers
+        self._synapse_config_changes = None
+        self._changed_workers = []
+        if self.apply_synapse_config_changes(previous, current, changed_workers):
+            return True
+        self.render_error = "Synapse processes failed their health checks after restarting"
         return False
 
     def render_configs(self):
         """Render configuration for the homeserver and enabled bridges."""
         ircd_config = True
         synapse_config = self.render_synapse_config()
+        workers_config = (
+            synapse_config and self.render_worker_configs() and self.apply_rendered_changes()
+        )
         if self.charm_config.get("enable-ircd"):
             ircd_config = self.render_ircd_config()
-        return synapse_config and ircd_config
+        return synapse_config and workers_config and ircd_config
 
     def check_snap_installed(self, snapname):
         """Verify a snap is installed."""
@@ -544,6 +2603,24 @@ class MatrixHelper:
                 self.remove_snap(self.matrix_ircd_snap)
         return synapse_result and ircd_result
 
+    def schedule_configure(self):
+        """
+        Configure Matrix once when the hook exits.
+
+        Handlers for config and relation changes can request configuration any number
+        of times during a hook, they are coalesced into a single configure call.
+        """
+        if not self._configure_scheduled:
+            self._configure_scheduled = True
+            hookenv.atexit(self.configure_at_exit)
+
+    def configure_at_exit(self):
+        """Configure Matrix and close the PostgreSQL pool, exit callbacks registered now would not run."""
+        try:
+            self.configure()
+        finally:
+            self.close_pgsql_pool()
+
     def configure(self):
         """
         Configure Matrix.
@@ -553,14 +2630,26 @@ class MatrixHelper:
         """
         hookenv.log("Ensuring snap(s) installed", hookenv.DEBUG)
         if self.install_snaps():
+            if not self.is_main_unit():
+                hookenv.log("Ensuring the main process is stopped on a worker unit", hookenv.DEBUG)
+                self.stop_synapse()
+                self.publish_peer_info()
+            hookenv.log("Ensuring Redis available for replication", hookenv.DEBUG)
+            self.configure_local_redis()
+            hookenv.log("Ensuring uploads tmpfs mounted as configured", hookenv.DEBUG)
+            self.configure_uploads_tmpfs()
+            hookenv.log("Configuring media purge and database maintenance timers", hookenv.DEBUG)
+            self.configure_timers()
             hookenv.log("Rendering config(s)", hookenv.DEBUG)
             if self.render_configs():
                 hookenv.log("Starting service(s)", hookenv.DEBUG)
                 if self.start_services():
                     hookenv.log("Opening ports for service(s)", hookenv.DEBUG)
-                    hookenv.status_set("active", self.HEALTHY)
+                    hookenv.status_set("active", self.get_active_status())
                     hookenv.open_port(8008)
                     hookenv.open_port(8448)
+                    self.publish_metrics_targets()
+                    self.publish_peer_info()
                     if self.charm_config.get("enable-ircd"):
                         hookenv.open_port(self.irc_internal_port)
                     else:
@@ -571,7 +2660,9 @@ class MatrixHelper:
                     hookenv.status_set("blocked", "Matrix services are not running.")
             else:
                 hookenv.log("Configuration failed to render", hookenv.DEBUG)
-                hookenv.status_set("blocked", "Trying to render configuration...")
+                hookenv.status_set(
+                    "blocked", self.render_error or "Trying to render configuration..."
+                )
         else:
             hookenv.log("Snap installation failure", hookenv.DEBUG)
             hookenv.status_set(
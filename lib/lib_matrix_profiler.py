@@ -0,0 +1,162 @@
+"""Opt-in profiling of hook execution for the Matrix charm."""
+import functools
+import inspect
+import subprocess
+import time
+
+from charmhelpers.core import hookenv, unitdata
+
+
+class HookProfiler:
+    """Record wall time, subprocess count and database round-trips of a hook into the unit KV store."""
+
+    kv_key = "hook-profile"
+    history = 50
+    # MatrixHelper methods which each make one round-trip to PostgreSQL
+    db_methods = ("pgsql_query", "pgsql_transaction")
+
+    def __init__(self):
+        """Start timing the current hook."""
+        self.kv = unitdata.kv()
+        self.started = time.time()
+        self.start = time.monotonic()
+        self.subprocesses = 0
+        self.timings = {}
+        self._popen_init = None
+        self._handler_invoke = None
+
+    def record(self, name, elapsed):
+        """Add a call and its elapsed time to the timings for name."""
+        timing = self.timings.setdefault(name, {"calls": 0, "time": 0.0})
+        timing["calls"] += 1
+        timing["time"] += elapsed
+
+    def wrap(self, name, function):
+        """Return function wrapped to record the time of each call under name."""
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(name, time.monotonic() - start)
+
+        return timed
+
+    def instrument_helper(self, helper):
+        """Time every public method of the provided helper instance."""
+        for name, method in inspect.getmembers(helper, inspect.ismethod):
+            if not name.startswith("_"):
+                setattr(
+                    helper,
+                    name,
+                    self.wrap("{}.{}".format(type(helper).__name__, name), method),
+                )
+
+    def instrument_subprocesses(self):
+        """Count every subprocess started during the hook."""
+        popen_init = self._popen_init = subprocess.Popen.__init__
+
+        def counted_init(popen, *args, **kwargs):
+            self.subprocesses += 1
+            return popen_init(popen, *args, **kwargs)
+
+        subprocess.Popen.__init__ = counted_init
+
+    def instrument_handlers(self):
+        """Time each reactive handler invoked during the hook."""
+        from charms.reactive.bus import Handler
+
+        handler_invoke = self._handler_invoke = Handler.invoke
+
+        def timed_invoke(handler):
+            start = time.monotonic()
+            try:
+                return handler_invoke(handler)
+            finally:
+                self.record("handler:{}".format(handler.id()), time.monotonic() - start)
+
+        Handler.invoke = timed_invoke
+
+    def uninstrument(self):
+        """Restore subprocess and reactive handler behaviour."""
+        if self._popen_init:
+            subprocess.Popen.__init__ = self._popen_init
+            self._popen_init = None
+        if self._handler_invoke:
+            from charms.reactive.bus import Handler
+
+            Handler.invoke = self._handler_invoke
+            self._handler_invoke = None
+
+    def get_db_round_trips(self):
+        """Return the number of database round-trips made during the hook."""
+        return sum(
+            timing["calls"]
+            for name, timing in self.timings.items()
+            if name.split(".")[-1] in self.db_methods
+        )
+
+    def save(self):
+        """Append the profile of this hook to the KV store, keeping the most recent runs."""
+        self.uninstrument()
+        runs = self.kv.get(self.kv_key, [])
+        runs.append(
+            {
+                "hook": hookenv.hook_name(),
+                "started": self.started,
+                "wall_time": time.monotonic() - self.start,
+                "subprocesses": self.subprocesses,
+                "db_round_trips": self.get_db_round_trips(),
+                "timings": self.timings,
+            }
+        )
+        self.kv.set(self.kv_key, runs[-self.history:])
+        self.kv.flush()
+
+
+def start_profiling(helper=None):
+    """
+    Profile the running hook if enabled in the charm config, returning the profiler.
+
+    A helper constructed later in the hook can be passed to instrument_helper.
+    The profile is saved when the hook exits. Returns None when profiling is disabled.
+    """
+    if not hookenv.config().get("enable-hook-profiling"):
+        return None
+    profiler = HookProfiler()
+    if helper is not None:
+        profiler.instrument_helper(helper)
+    profiler.instrument_subprocesses()
+    profiler.instrument_handlers()
+    hookenv.atexit(profiler.save)
+    return profiler
+
+
+def profile_report(runs=10, top=5):
+    """Return the slowest hooks and the slowest methods and handlers over the last runs."""
+    history = unitdata.kv().get(HookProfiler.kv_key, [])[-runs:]
+    slowest_hooks = sorted(history, key=lambda run: run["wall_time"], reverse=True)[:top]
+    totals = {}
+    for run in history:
+        for name, timing in run["timings"].items():
+            total = totals.setdefault(name, {"name": name, "calls": 0, "time": 0.0})
+            total["calls"] += timing["calls"]
+            total["time"] += timing["time"]
+    slowest_methods = sorted(totals.values(), key=lambda total: total["time"], reverse=True)[:top]
+    return {
+        "runs": len(history),
+        "hooks": [
+            {
+                "hook": run["hook"],
+                "started": run["started"],
+                "wall_time": round(run["wall_time"], 3),
+                "subprocesses": run["subprocesses"],
+                "db_round_trips": run["db_round_trips"],
+            }
+            for run in slowest_hooks
+        ],
+        "methods": [
+            dict(total, time=round(total["time"], 3)) for total in slowest_methods
+        ],
+    }
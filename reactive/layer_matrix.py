@@ -1,11 +1,13 @@
 """Matrix helper class for reactive charm layer."""
 from charms.layer import snap
 from lib_matrix import MatrixHelper
+from lib_matrix_profiler import start_profiling
 from charmhelpers.core import hookenv
 from charms.reactive import (
     clear_flag,
     endpoint_from_flag,
     endpoint_from_name,
+    hook,
     set_flag,
     when,
     when_all,
@@ -14,7 +16,22 @@ from charms.reactive import (
 )
 
 
-matrix = MatrixHelper()
+profiler = start_profiling()
+_matrix = None
+
+
+def get_matrix():
+    """Return the Matrix helper, constructing it on first use.
+
+    Most hooks dispatch no handlers that need the helper, so it is only
+    constructed, loading config and the KV store, when a handler needs it.
+    """
+    global _matrix
+    if _matrix is None:
+        _matrix = MatrixHelper()
+        if profiler:
+            profiler.instrument_helper(_matrix)
+    return _matrix
 
 
 @when_not("snap.installed.matrix-synapse")
@@ -28,7 +45,7 @@ def install_matrix_synapse():
 @when_not("snap.installed.matrix-ircd")
 def install_matrix_ircd():
     """Installs matrix IRCd snap."""
-    if matrix.charm_config.get("enable-ircd"):
+    if hookenv.config().get("enable-ircd"):
         hookenv.status_set("maintenance", "Installing Matrix IRCd")
         snap.install("matrix-ircd")
         hookenv.status_set("active", "Matrix Installed")
@@ -40,7 +57,10 @@ def set_pgsql_db():
     hookenv.log("Requesting matrix DB from {}".format(hookenv.remote_unit()),
                 hookenv.DEBUG)
     pgsql = endpoint_from_flag("pgsql.database.connected")
-    pgsql.set_database(matrix.db_name)
+    pgsql.set_database(MatrixHelper.db_name)
+    # pgstatindex measures index bloat for database maintenance
+    pgsql.set_extensions(["pgstattuple"])
+    pgsql.set_roles(["pg_stat_scan_tables"])
 
 
 @when("pgsql.database.available")
@@ -49,7 +69,7 @@ def save_pgsql_db():
     pgsql = endpoint_from_flag("pgsql.database.available")
     hookenv.log("Recieved matrix DB from PostgreSQL: {}".format(pgsql),
                 hookenv.DEBUG)
-    matrix.save_pgsql_conf(pgsql)
+    get_matrix().save_pgsql_conf(pgsql)
 
 
 @when_any("pgsql.departed")
@@ -57,7 +77,53 @@ def remove_pgsql():
     """Remove the PostgreSQL DB configuration when the relation has been removed."""
     hookenv.status_set("maintenance", "Cleaning up removed pgsql relation")
     hookenv.log("Removing config for: {}".format(hookenv.remote_unit()))
-    matrix.remove_pgsql_conf()
+    get_matrix().remove_pgsql_conf()
+
+
+@when("redis.available")
+@when("endpoint.redis.changed")
+def save_redis():
+    """Save related Redis configuration in the key value store."""
+    redis = endpoint_from_flag("redis.available")
+    hookenv.log("Recieved Redis configuration: {}".format(redis),
+                hookenv.DEBUG)
+    get_matrix().save_redis_conf(redis)
+    clear_flag("endpoint.redis.changed")
+    set_flag("matrix.redis.changed")
+
+
+@when("endpoint.redis.departed")
+@when_not("endpoint.redis.joined")
+def remove_redis():
+    """Remove the Redis configuration when the relation has been removed."""
+    hookenv.log("Removing related Redis configuration", hookenv.DEBUG)
+    get_matrix().remove_redis_conf()
+    clear_flag("endpoint.redis.departed")
+    set_flag("matrix.redis.changed")
+
+
+@hook("{media,uploads}-storage-attached")
+def attach_storage():
+    """Save the location of attached media or uploads storage."""
+    name = hookenv.hook_name().split("-")[0]
+    get_matrix().save_storage_location(name)
+    set_flag("matrix.storage.changed")
+
+
+@hook("{media,uploads}-storage-detaching")
+def detach_storage():
+    """Move synapse off media or uploads storage which is being detached."""
+    name = hookenv.hook_name().split("-")[0]
+    get_matrix().remove_storage_location(name)
+    set_flag("matrix.storage.changed")
+
+
+@hook("prometheus-relation-{joined,changed}")
+def publish_metrics():
+    """Publish metrics scrape targets for synapse and its workers to prometheus."""
+    hookenv.log("Publishing metrics targets to {}".format(hookenv.remote_unit()),
+                hookenv.DEBUG)
+    get_matrix().publish_metrics_targets()
 
 
 @when("reverseproxy.departed")
@@ -66,8 +132,8 @@ def remove_proxy():
     hookenv.status_set("maintenance", "Removing reverse proxy relation")
     hookenv.log("Removing config for: {}".format(hookenv.remote_unit()),
                 hookenv.DEBUG)
-    matrix.remove_proxy_config()
-    hookenv.status_set("active", matrix.HEALTHY)
+    get_matrix().remove_proxy_config()
+    hookenv.status_set("active", get_matrix().get_active_status())
     clear_flag("reverseproxy.configured")
 
 
@@ -92,22 +158,60 @@ def configure_proxy():
     hookenv.log("Configuring reverse proxy via: {}".format(hookenv.remote_unit()), hookenv.DEBUG)
 
     interface = endpoint_from_name("reverseproxy")
-    matrix.configure_proxy(interface)
+    get_matrix().configure_proxy(interface)
 
-    hookenv.status_set("active", matrix.HEALTHY)
+    hookenv.status_set("active", get_matrix().get_active_status())
     set_flag("reverseproxy.configured")
 
 
+@when("reverseproxy.configured")
+@when("config.changed")
+def reconfigure_proxy():
+    """Update the reverse proxy configuration, as workers and their routes may have changed."""
+    clear_flag("reverseproxy.configured")
+
+
+@hook("matrix-peers-relation-{joined,changed,departed}", "leader-elected", "leader-settings-changed")
+def update_peers():
+    """Share this unit's address, role and workers with peers and update the reverse proxy with theirs.
+
+    Changes of leadership or of the secrets shared by the leader change the role and
+    configuration of this unit, so matrix is reconfigured.
+    """
+    get_matrix().publish_peer_info()
+    clear_flag("reverseproxy.configured")
+    set_flag("matrix.peers.changed")
+
+
+@hook("update-status")
+def retry_pending_restarts():
+    """Reconfigure matrix to restart workers skipped when a rolling restart failed its health checks."""
+    matrix = get_matrix()
+    if matrix.has_pending_restarts():
+        hookenv.log("Retrying pending worker restarts", hookenv.DEBUG)
+        matrix.schedule_configure()
+
+
 @when_all("snap.installed.matrix-synapse", "pgsql.database.available")
-@when_any("config.changed", "pgsql.database.changed")
+@when_any(
+    "config.changed",
+    "pgsql.database.changed",
+    "matrix.redis.changed",
+    "matrix.storage.changed",
+    "matrix.peers.changed",
+)
 def configure_matrix(reverseproxy, *args):
     """Upgrade and reconfigure matrix on configuration changes.
 
     Templaes the homeserver and assosciated bridge
     configuration, ensures snaps are installed and updates,
-    and services running.
+    and services running. Configuration runs once at the end
+    of the hook, however many changes are handled in it.
     """
     hookenv.status_set("maintenance", "Configuring matrix")
-    hookenv.log("Configuring matrix", hookenv.DEBUG)
+    hookenv.log("Scheduling matrix configuration", hookenv.DEBUG)
 
-    matrix.configure()
+    get_matrix().schedule_configure()
+    clear_flag("matrix.redis.changed")
+    clear_flag("matrix.storage.changed")
+    clear_flag("matrix.peers.changed")
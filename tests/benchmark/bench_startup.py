@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+"""Benchmark hook startup of the Matrix charm.
+
+Each measurement runs in a fresh interpreter with stand-in hook tools on the
+PATH, timing the import of charmhelpers and charms.reactive, the import of
+lib_matrix and the import and initialisation of the reactive layer, as done
+at the start of every hook. Pass --charm-dir to benchmark another checkout of
+the charm, such as a previous revision, for comparison.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+import yaml
+
+MEASURE = """
+import importlib.util
+import json
+import time
+
+start = time.perf_counter()
+import charmhelpers.core.hookenv
+import charms.reactive
+frameworks = time.perf_counter()
+import lib_matrix
+lib = time.perf_counter()
+spec = importlib.util.spec_from_file_location("layer_matrix", "reactive/layer_matrix.py")
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+reactive = time.perf_counter()
+print(json.dumps({
+    "frameworks": frameworks - start,
+    "lib_matrix": lib - frameworks,
+    "reactive": reactive - lib,
+    "total": reactive - start,
+}))
+"""
+
+HOOK_TOOLS = ("juju-log", "status-set", "relation-ids", "relation-set", "open-port", "close-port")
+
+
+def write_hook_tools(charm_dir, tools_dir):
+    """Write stand-in hook tools, with config-get returning the charm's config defaults."""
+    with open(os.path.join(charm_dir, "config.yaml")) as config_file:
+        options = yaml.safe_load(config_file)["options"]
+    config_file = os.path.join(tools_dir, "config.json")
+    with open(config_file, "w") as config_json:
+        json.dump({key: option.get("default") for key, option in options.items()}, config_json)
+    tools = {"config-get": "#!/bin/sh\ncat {}\n".format(config_file)}
+    tools.update({tool: "#!/bin/sh\nexit 0\n" for tool in HOOK_TOOLS})
+    for tool, content in tools.items():
+        tool_path = os.path.join(tools_dir, tool)
+        with open(tool_path, "w") as tool_file:
+            tool_file.write(content)
+        os.chmod(tool_path, 0o755)
+
+
+def measure(charm_dir, tools_dir, runs):
+    """Return the median of each startup timing over the provided number of runs."""
+    env = dict(os.environ)
+    env.update(
+        {
+            "PATH": "{}:{}".format(tools_dir, env.get("PATH", "")),
+            "PYTHONPATH": ":".join(
+                filter(
+                    None,
+                    [
+                        os.path.join(charm_dir, "lib"),
+                        os.path.join(charm_dir, "tests", "unit"),
+                        env.get("PYTHONPATH"),
+                    ],
+                )
+            ),
+            "CHARM_DIR": charm_dir,
+            "JUJU_CHARM_DIR": charm_dir,
+            "JUJU_UNIT_NAME": "matrix/0",
+            "JUJU_HOOK_NAME": "update-status",
+            "UNIT_STATE_DB": os.path.join(tools_dir, "unit-state.db"),
+        }
+    )
+    samples = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, "-c", MEASURE], cwd=charm_dir, env=env, stderr=subprocess.DEVNULL
+        )
+        samples.append(json.loads(output.decode("utf-8").strip().splitlines()[-1]))
+    return {key: statistics.median(sample[key] for sample in samples) for key in samples[0]}
+
+
+def main():
+    """Run the benchmark and print the median timings in milliseconds."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--charm-dir",
+        default=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    )
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+    charm_dir = os.path.abspath(args.charm_dir)
+    with tempfile.TemporaryDirectory() as tools_dir:
+        write_hook_tools(charm_dir, tools_dir)
+        timings = measure(charm_dir, tools_dir, args.runs)
+    print("Median hook startup over {} runs of {}".format(args.runs, charm_dir))
+    for key, value in timings.items():
+        print("  {:<12} {:8.1f} ms".format(key, value * 1000))
+
+
+if __name__ == "__main__":
+    main()
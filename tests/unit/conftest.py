@@ -2,6 +2,7 @@
 """Test fixtures for unit testing."""
 import mock
 import pytest
+import sys
 
 from charmhelpers.core import unitdata
 
@@ -113,6 +114,16 @@ def mock_lsb_release(monkeypatch):
     return mock_lsb
 
 
+def mock_connection_pool(connect):
+    """Return a mocked psycopg2 connection pool, handing out a connection from connect."""
+    def mocked_pool(minconn, maxconn, **kwargs):
+        pool = mock.Mock()
+        pool.getconn.return_value = connect(**kwargs)
+        return pool
+
+    return mocked_pool
+
+
 @pytest.fixture
 def mock_psycopg2(monkeypatch):
     """Mock useful psycopg2 calls."""
@@ -125,9 +136,14 @@ def mock_psycopg2(monkeypatch):
         return True
 
     class Cursor():
+        description = None
+
         def execute(self, query, vals=None):
             return True
 
+        def fetchall(self):
+            return []
+
         def close(self):
             return True
 
@@ -154,11 +170,16 @@ def mock_psycopg2(monkeypatch):
 
     mock_connect.side_effect = mocked_connect
     mock_execute.side_effect = mocked_execute
-    monkeypatch.setattr("lib_matrix.psycopg2", mock_module)
-    monkeypatch.setattr("lib_matrix.psycopg2.connect", mock_connect)
-    monkeypatch.setattr("lib_matrix.psycopg2.Cursor", Cursor)
-    monkeypatch.setattr("lib_matrix.psycopg2.Error", Error)
-    monkeypatch.setattr("lib_matrix.psycopg2.Cursor.execute", mock_execute)
+    mock_module.connect = mock_connect
+    mock_module.Cursor = Cursor
+    mock_module.Error = Error
+    mock_module.Cursor.execute = mock_execute
+    mock_module.pool.SimpleConnectionPool = mock_connection_pool(mock_connect)
+    mock_module.extras.execute_values = mock.Mock()
+    # psycopg2 is imported where it is used, so mock the modules being imported
+    monkeypatch.setitem(sys.modules, "psycopg2", mock_module)
+    monkeypatch.setitem(sys.modules, "psycopg2.pool", mock_module.pool)
+    monkeypatch.setitem(sys.modules, "psycopg2.extras", mock_module.extras)
 
     return mock_module
 
@@ -175,6 +196,53 @@ def mock_check_output(monkeypatch):
     return mock_call
 
 
+@pytest.fixture
+def mock_check_call(monkeypatch):
+    """Mock subprocess check_call on lib_matrix."""
+    mock_call = mock.Mock()
+    monkeypatch.setattr("lib_matrix.check_call", mock_call)
+    return mock_call
+
+
+@pytest.fixture
+def mock_fetch(monkeypatch):
+    """Mock apt package handling on lib_matrix, nothing is installed to start with."""
+    installed = []
+
+    def mocked_filter_installed_packages(packages):
+        return [package for package in packages if package not in installed]
+
+    def mocked_apt_install(packages, fatal=False):
+        installed.extend(packages)
+
+    mock_apt_install = mock.Mock()
+    mock_apt_install.side_effect = mocked_apt_install
+    monkeypatch.setattr("charmhelpers.fetch.apt_install", mock_apt_install)
+    monkeypatch.setattr(
+        "charmhelpers.fetch.filter_installed_packages", mocked_filter_installed_packages
+    )
+    return mock_apt_install
+
+
+@pytest.fixture
+def mock_redis():
+    """Mock a related Redis endpoint, standing in for a Redis server."""
+    redis = mock.Mock()
+    redis.relation_data.return_value = [
+        {"host": "redis.mock", "port": 6380, "password": "redispass"}
+    ]
+    return redis
+
+
+@pytest.fixture
+def mock_health(monkeypatch):
+    """Mock synapse health checks, with every process healthy unless a test changes it."""
+    mock_check_health = mock.Mock(return_value=True)
+    monkeypatch.setattr("lib_matrix.MatrixHelper.check_health", mock_check_health)
+    monkeypatch.setattr("lib_matrix.MatrixHelper.health_check_interval", 0)
+    return mock_check_health
+
+
 @pytest.fixture
 def mock_action_get(monkeypatch):
     """Mock the action_get function."""
@@ -245,6 +313,49 @@ def mock_remote_unit(monkeypatch):
     monkeypatch.setattr("lib_matrix.hookenv.remote_unit", lambda: "unit-mock/0")
 
 
+@pytest.fixture
+def mock_relations(monkeypatch):
+    """Mock relation data access, with no relations present unless a test adds them."""
+    relation_ids = {}
+    related_units = {}
+    relation_data = {}
+    monkeypatch.setattr(
+        "lib_matrix.hookenv.relation_ids", lambda name: relation_ids.get(name, [])
+    )
+    monkeypatch.setattr(
+        "lib_matrix.hookenv.related_units", lambda relation_id: related_units.get(relation_id, [])
+    )
+    monkeypatch.setattr(
+        "lib_matrix.hookenv.relation_get", lambda rid, unit: relation_data.get(unit)
+    )
+    mock_relation_set = mock.Mock()
+    monkeypatch.setattr("lib_matrix.hookenv.relation_set", mock_relation_set)
+    mock_relation_set.relation_ids = relation_ids
+    mock_relation_set.related_units = related_units
+    mock_relation_set.relation_data = relation_data
+    return mock_relation_set
+
+
+@pytest.fixture
+def mock_leader(monkeypatch):
+    """Mock leadership and leader settings, with the unit being the leader unless a test changes it."""
+    mock_is_leader = mock.Mock(return_value=True)
+    mock_is_leader.settings = {}
+
+    def leader_get(attribute=None):
+        if attribute is None:
+            return dict(mock_is_leader.settings)
+        return mock_is_leader.settings.get(attribute)
+
+    def leader_set(settings=None, **kwargs):
+        mock_is_leader.settings.update(settings or {}, **kwargs)
+
+    monkeypatch.setattr("lib_matrix.hookenv.is_leader", mock_is_leader)
+    monkeypatch.setattr("lib_matrix.hookenv.leader_get", leader_get)
+    monkeypatch.setattr("lib_matrix.hookenv.leader_set", leader_set)
+    return mock_is_leader
+
+
 @pytest.fixture
 def mock_charm_dir(monkeypatch):
     """Mock the charm dir path."""
@@ -293,6 +404,12 @@ def matrix(
     mock_socket,
     mock_snap,
     mock_unit_db,
+    mock_check_call,
+    mock_fetch,
+    mock_relations,
+    mock_leader,
+    mock_juju_unit,
+    mock_health,
     monkeypatch,
 ):
     """Mock the Matrix helper library."""
@@ -303,10 +420,13 @@ def matrix(
     # Example config file patching
     synapse_config_file = tmpdir.join("homeserver.yaml")
     helper.synapse_config = synapse_config_file.strpath
+    helper.synapse_log_config = tmpdir.join("log.yaml").strpath
     ircd_config_file = tmpdir.join("matrix-ircd.env")
     helper.matrix_ircd_config = ircd_config_file.strpath
     synapse_signing_key_file = tmpdir.join("signing.key")
     helper.synapse_signing_key_file = synapse_signing_key_file.strpath
+    helper.synapse_worker_conf_dir = tmpdir.mkdir("workers").strpath
+    helper.synapse_worker_service_dir = tmpdir.mkdir("systemd").strpath
 
     # Any other functions that load helper will get this version
     monkeypatch.setattr("lib_matrix.MatrixHelper", lambda: helper)
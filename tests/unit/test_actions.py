@@ -1,5 +1,6 @@
 """Unit tests for the Matrix charm."""
 import imp
+import json
 import mock
 
 
@@ -19,3 +20,103 @@ def test_register_user_action(matrix, mock_action_get, mock_action_set, mock_act
     assert mock_function.call_count == 0
     imp.load_source("register_user", "./actions/register-user")
     assert mock_function.call_count == 1
+
+
+def test_register_users_action(matrix, mock_action_get, mock_action_set, mock_action_fail, mock_juju_unit, monkeypatch):
+    """Test bulk registration via the action."""
+    mock_function = mock.Mock(return_value=([{"user": "blah", "outcome": "success", "message": ""}], 1.0))
+    monkeypatch.setattr(matrix, "register_users", mock_function)
+    assert mock_function.call_count == 0
+    imp.load_source("register_users", "./actions/register-users")
+    assert mock_function.call_count == 1
+    assert mock_action_set.call_args[0][0]["registered"] == 1
+    assert mock_action_fail.call_count == 0
+    monkeypatch.setattr(matrix, "get_shared_secret", lambda: None)
+    imp.load_source("register_users", "./actions/register-users")
+    assert mock_function.call_count == 1
+    assert mock_action_fail.call_count == 1
+
+
+def test_set_passwords_action(matrix, mock_action_get, mock_action_set, mock_action_fail, mock_juju_unit, monkeypatch):
+    """Test setting passwords in bulk via the action."""
+    mock_function = mock.Mock(return_value=[])
+    monkeypatch.setattr(matrix, "set_passwords", mock_function)
+    monkeypatch.setattr(matrix, "parse_users", lambda payload: [{"user": "blah", "password": "blah"}])
+    assert mock_function.call_count == 0
+    imp.load_source("set_passwords", "./actions/set-passwords")
+    assert mock_function.call_args == mock.call({"blah": "blah"})
+    assert mock_action_set.call_args[0][0]["not-found"] == "blah"
+
+
+def test_hook_profile_action(matrix, mock_action_set, mock_action_fail, monkeypatch):
+    """Test reporting hook profiles via the action."""
+    monkeypatch.setattr("charmhelpers.core.hookenv.action_get", lambda name: None)
+    imp.load_source("hook_profile", "./actions/hook-profile")
+    assert mock_action_fail.call_count == 1
+    matrix.kv.set(
+        "hook-profile",
+        [{"hook": "install", "started": 1, "wall_time": 1.0, "subprocesses": 1, "db_round_trips": 0, "timings": {}}],
+    )
+    imp.load_source("hook_profile", "./actions/hook-profile")
+    assert mock_action_set.call_args[0][0]["runs"] == 1
+
+
+def test_rolling_restart_action(matrix, mock_action_set, mock_action_fail, mock_juju_unit, monkeypatch):
+    """Test restarting synapse processes via the action."""
+    mock_function = mock.Mock(return_value=True)
+    monkeypatch.setattr(matrix, "rolling_restart", mock_function)
+    monkeypatch.setattr("charmhelpers.core.hookenv.action_get", lambda name: False)
+    imp.load_source("rolling_restart", "./actions/rolling-restart")
+    assert mock_function.call_args == mock.call(restart_main=False)
+    assert mock_action_set.call_args[0][0]["outcome"] == "success"
+    monkeypatch.setattr("charmhelpers.core.hookenv.action_get", lambda name: True)
+    imp.load_source("rolling_restart", "./actions/rolling-restart")
+    assert mock_function.call_args == mock.call(restart_main=True)
+    monkeypatch.setattr(matrix, "is_main_unit", lambda: False)
+    imp.load_source("rolling_restart", "./actions/rolling-restart")
+    assert mock_function.call_args == mock.call(restart_main=False)
+    mock_function.return_value = False
+    imp.load_source("rolling_restart", "./actions/rolling-restart")
+    assert mock_action_fail.call_count == 1
+
+
+def test_purge_media_actions(matrix, mock_action_set, mock_action_fail, mock_juju_unit, monkeypatch):
+    """Test purging remote and local media via the actions."""
+    result = {"deleted": 3, "bytes-freed": 100, "run-time": 1.0}
+    mock_remote = mock.Mock(return_value=(True, dict(result)))
+    mock_local = mock.Mock(return_value=(True, dict(result)))
+    monkeypatch.setattr(matrix, "purge_remote_media", mock_remote)
+    monkeypatch.setattr(matrix, "purge_local_media", mock_local)
+    params = {"older-than": "2d", "larger-than": "1k"}
+    monkeypatch.setattr("charmhelpers.core.hookenv.action_get", params.get)
+    imp.load_source("purge_remote_media", "./actions/purge-remote-media")
+    assert mock_remote.call_args == mock.call(2 * 86400)
+    assert mock_action_set.call_args[0][0]["bytes-freed"] == 100
+    imp.load_source("purge_local_media", "./actions/purge-local-media")
+    assert mock_local.call_args == mock.call(2 * 86400, 1024)
+    params["older-than"] = "soon"
+    imp.load_source("purge_local_media", "./actions/purge-local-media")
+    assert mock_action_fail.call_count == 1
+
+
+def test_db_maintenance_action(matrix, mock_action_set, mock_action_fail, mock_juju_unit, monkeypatch):
+    """Test maintaining database tables via the action."""
+    result = {
+        "tables": {"events": {"dead-ratio": 0.1, "needs-reindex": True}},
+        "vacuumed": ["events"],
+        "reindex": ["events"],
+        "reindex-check": "b-tree leaf density measured by pgstatindex",
+        "run-time": 1.0,
+    }
+    mock_function = mock.Mock(return_value=(True, result))
+    monkeypatch.setattr(matrix, "run_db_maintenance", mock_function)
+    params = {"tables": "events", "vacuum": True}
+    monkeypatch.setattr("charmhelpers.core.hookenv.action_get", params.get)
+    imp.load_source("db_maintenance", "./actions/db-maintenance")
+    assert mock_function.call_args == mock.call("events", True)
+    assert mock_action_set.call_args[0][0]["reindex"] == "events"
+    assert mock_action_set.call_args[0][0]["reindex-check"] == "b-tree leaf density measured by pgstatindex"
+    assert json.loads(mock_action_set.call_args[0][0]["tables"])["events"]["dead-ratio"] == 0.1
+    mock_function.return_value = (False, "permission denied")
+    imp.load_source("db_maintenance", "./actions/db-maintenance")
+    assert mock_action_fail.call_count == 1
@@ -4,6 +4,9 @@
 from charmhelpers.core import unitdata
 import mock
 import os
+import pytest
+import time
+import yaml
 
 
 db = mock.Mock()
@@ -31,10 +34,21 @@ def test_matrix_kv(matrix):
     assert isinstance(matrix.kv, unitdata.Storage)
 
 
-def test_hash_password(matrix, mock_check_output):
-    """Test the hash password function."""
+def test_hash_password(matrix):
+    """Test hashing passwords with the rendered pepper and bcrypt rounds."""
+    import bcrypt
+
+    with open(matrix.synapse_config, "w") as config_file:
+        config_file.write("bcrypt_rounds: 4\npassword_config:\n  pepper: mockpepper\n")
+    assert matrix.get_password_hash_config() == ("mockpepper", 4)
     result = matrix.hash_password("testpassword")
-    assert result == "mocked-output"
+    assert result.startswith("$2b$04$")
+    assert bcrypt.checkpw(b"testpasswordmockpepper", result.encode("ascii"))
+    hashes = matrix.hash_passwords(["one", "two"])
+    assert bcrypt.checkpw(b"onemockpepper", hashes[0].encode("ascii"))
+    assert bcrypt.checkpw(b"twomockpepper", hashes[1].encode("ascii"))
+    result = matrix.hash_password("x" * 80)
+    assert bcrypt.checkpw(b"x" * 72, result.encode("ascii"))
 
 
 def test_pgsql_configured(matrix):
@@ -56,26 +70,111 @@ def test_pgsql_query(matrix, mock_psycopg2):
     assert result is True
 
 
-def test_set_password(matrix, mock_check_output, mock_psycopg2):
+def test_pgsql_pool(matrix, mock_psycopg2):
+    """Test queries within a hook share pooled connections."""
+    matrix.save_pgsql_conf(db)
+    matrix.pgsql_query("SELECT 1;")
+    matrix.pgsql_query("SELECT 2;")
+    assert mock_psycopg2.connect.call_count == 1
+    matrix.close_pgsql_pool()
+    matrix.pgsql_query("SELECT 3;")
+    assert mock_psycopg2.connect.call_count == 2
+
+
+def test_pgsql_batch(matrix, mock_psycopg2):
+    """Test the batch query function."""
+    assert matrix.pgsql_batch("INSERT INTO t VALUES %s", [(1,), (2,)]) is False
+    matrix.save_pgsql_conf(db)
+    result = matrix.pgsql_batch("INSERT INTO t VALUES %s", [(1,), (2,)])
+    assert result is True
+    assert mock_psycopg2.extras.execute_values.call_count == 1
+    assert mock_psycopg2.extras.execute_values.call_args[0][1:] == (
+        "INSERT INTO t VALUES %s",
+        [(1,), (2,)],
+    )
+    mock_psycopg2.extras.execute_values.return_value = [(1,), (2,)]
+    result = matrix.pgsql_batch("INSERT INTO t VALUES %s RETURNING id", [(1,), (2,)], fetch=True)
+    assert result == [(1,), (2,)]
+
+
+def test_pgsql_transaction(matrix, mock_psycopg2):
+    """Test transactions are rolled back on error."""
+    matrix.save_pgsql_conf(db)
+    connection = matrix.get_pgsql_pool().getconn()
+    connection.commit = mock.Mock()
+    connection.rollback = mock.Mock()
+    with matrix.pgsql_transaction() as cursor:
+        cursor.execute("SELECT 1;")
+    assert connection.commit.call_count == 1
+    try:
+        with matrix.pgsql_transaction():
+            raise ValueError("mocked")
+    except ValueError:
+        pass
+    assert connection.commit.call_count == 1
+    assert connection.rollback.call_count == 1
+
+
+def test_get_db_pool_size(matrix, monkeypatch):
+    """Test sizing the database connection pool from config and PostgreSQL limits."""
+    assert matrix.get_db_pool_size() == (5, 10)
+    matrix.charm_config["db-pool-auto"] = True
+    mock_query = mock.Mock(return_value=[(97,)])
+    monkeypatch.setattr(matrix, "pgsql_query", mock_query)
+    matrix.charm_config["workers"] = "synchrotron=2,federation_reader=1"
+    assert matrix.get_db_pool_size() == (5, 23)
+    matrix.get_db_pool_size()
+    assert mock_query.call_count == 1
+    matrix.save_pgsql_conf(db)
+    mock_query.return_value = [(7,)]
+    assert matrix.get_db_pool_size() == (1, 1)
+    matrix.save_pgsql_conf(db)
+    mock_query.return_value = "too many clients"
+    assert matrix.get_db_pool_size() == (5, 10)
+
+
+def test_get_db_pool_size_peers(matrix, mock_relations, monkeypatch):
+    """Test auto sizing splits connections between the processes of every unit."""
+    matrix.charm_config["db-pool-auto"] = True
+    monkeypatch.setattr(matrix, "pgsql_query", mock.Mock(return_value=[(105,)]))
+    matrix.charm_config["workers"] = "synchrotron=2"
+    mock_relations.relation_ids["matrix-peers"] = ["matrix-peers:1"]
+    mock_relations.related_units["matrix-peers:1"] = ["matrix/1"]
+    mock_relations.relation_data["matrix/1"] = {
+        "address": "10.0.0.2",
+        "workers": '[{"type": "synchrotron", "port": 8083}, {"type": "synchrotron", "port": 8084}]',
+    }
+    assert matrix.get_db_pool_size() == (5, 19)
+
+
+def test_set_password(matrix, mock_psycopg2, monkeypatch):
     """Test setting the password for a provided synapse user."""
     matrix.save_pgsql_conf(db)
-    matrix.set_password("testuser", "testpassword")
-    assert mock_check_output.called_with(
-        [
-            "snap",
-            "run",
-            "{}.hash_password".format(matrix.synapse_snap),
-            "-c",
-            matrix.synapse_config,
-            "-p",
-            "testpassword",
-        ]
+    monkeypatch.setattr(matrix, "hash_password", lambda password: "testhash")
+    mock_query = mock.Mock(return_value=None)
+    monkeypatch.setattr(matrix, "pgsql_query", mock_query)
+    assert matrix.set_password("testuser", "testpassword") is None
+    assert mock_query.call_args == mock.call(
+        "UPDATE users SET password_hash = %s WHERE name = %s;",
+        ("testhash", "@testuser:mock.fqdn"),
     )
-    assert mock_check_output.call_count == 1
-    assert mock_psycopg2.Cursor.execute.called_with(
-        "UPDATE users SET password_hash='testhash' WHERE name='testuser';"
+
+
+def test_set_passwords(matrix, mock_psycopg2, monkeypatch):
+    """Test setting many passwords in a single batch."""
+    matrix.save_pgsql_conf(db)
+    monkeypatch.setattr(
+        matrix, "hash_passwords", lambda passwords: ["hash-" + password for password in passwords]
     )
-    assert mock_psycopg2.Cursor.execute.call_count == 1
+    mock_batch = mock.Mock(return_value=[("@alice:mock.fqdn",)])
+    monkeypatch.setattr(matrix, "pgsql_batch", mock_batch)
+    result = matrix.set_passwords({"alice": "one", "@bob:mock.fqdn": "two"})
+    assert result == [("@alice:mock.fqdn",)]
+    assert mock_batch.call_args[0][1] == [
+        ("@alice:mock.fqdn", "hash-one"),
+        ("@bob:mock.fqdn", "hash-two"),
+    ]
+    assert mock_batch.call_args[1] == {"fetch": True}
 
 
 def test_register_user(matrix, mock_check_output, mock_psycopg2, mock_random):
@@ -115,6 +214,207 @@ def test_register_user(matrix, mock_check_output, mock_psycopg2, mock_random):
     assert mock_check_output.call_count == 2
 
 
+def test_parse_users(matrix):
+    """Test parsing of users from JSON and CSV payloads."""
+    users = matrix.parse_users('[{"user": "alice", "password": "pw", "admin": true}, {"user": "bob"}]')
+    assert users == [
+        {"user": "alice", "password": "pw", "admin": True},
+        {"user": "bob", "admin": False},
+    ]
+    users = matrix.parse_users("user,password,admin\nalice,pw,true\n\nbob,,false\n")
+    assert users == [
+        {"user": "alice", "password": "pw", "admin": True},
+        {"user": "bob", "password": "", "admin": False},
+    ]
+    assert matrix.parse_users("carol") == [{"user": "carol", "admin": False}]
+    with pytest.raises(ValueError):
+        matrix.parse_users('[{"password": "pw"}]')
+    with pytest.raises(ValueError):
+        matrix.parse_users('["alice"]')
+
+
+def test_parse_duration_and_size():
+    """Test parsing of durations and sizes from config and action parameters."""
+    from lib_matrix import parse_duration, parse_size
+
+    assert parse_duration("90d") == 90 * 86400
+    assert parse_duration("12h") == 12 * 3600
+    assert parse_duration("30") == 30
+    assert parse_size("10M") == 10 * 1024 ** 2
+    assert parse_size("1.5k") == 1536
+    assert parse_size("") == 0
+
+
+def test_synapse_admin_request(matrix, monkeypatch):
+    """Test admin API requests log in as the charm admin user, again once a token expires."""
+    mock_register = mock.Mock(return_value=(True, "@matrix-charm-admin:mock.fqdn"))
+    monkeypatch.setattr(matrix, "register_user_api", mock_register)
+    mock_request = mock.Mock()
+    mock_request.side_effect = [
+        (200, {"access_token": "token1"}),
+        (200, {"deleted": 1}),
+        (401, {"error": "Unknown token"}),
+        (200, {"access_token": "token2"}),
+        (200, {"deleted": 2}),
+    ]
+    monkeypatch.setattr(matrix, "admin_api_request", mock_request)
+    assert matrix.synapse_admin_request("POST", "/mock") == (200, {"deleted": 1})
+    assert mock_request.call_args == mock.call("POST", "/mock", None, token="token1", port=None)
+    assert matrix.synapse_admin_request("POST", "/mock") == (200, {"deleted": 2})
+    assert mock_request.call_args == mock.call("POST", "/mock", None, token="token2", port=None)
+    assert mock_register.call_count == 2
+    assert matrix.kv.get("admin_access_token") == "token2"
+
+
+def test_purge_media(matrix, tmpdir, monkeypatch):
+    """Test media is purged in batches, resuming from the previous purge."""
+    matrix.charm_config["media-store-path"] = tmpdir.strpath
+    mock_request = mock.Mock(return_value=(200, {"deleted": 2, "total": 1}))
+    monkeypatch.setattr(matrix, "synapse_admin_request", mock_request)
+    success, result = matrix.purge_remote_media(86400)
+    assert success is True
+    assert mock_request.call_count == matrix.media_purge_initial_batches
+    assert result["deleted"] == 2 * matrix.media_purge_initial_batches
+    assert "bytes-freed" in result and "run-time" in result
+    assert "/_synapse/admin/v1/purge_media_cache?before_ts=" in mock_request.call_args[0][1]
+
+    mock_request.reset_mock()
+    success, result = matrix.purge_remote_media(86400)
+    assert mock_request.call_count == 1
+
+    success, result = matrix.purge_local_media(86400, 1024)
+    assert mock_request.call_args[0][1].startswith("/_synapse/admin/v1/media/mock.fqdn/delete?before_ts=")
+    assert mock_request.call_args[0][1].endswith("&size_gt=1024&keep_profiles=true")
+
+    matrix.charm_config["workers"] = "media_repository=1"
+    matrix.purge_local_media(86400)
+    assert mock_request.call_args[1]["port"] == 8083
+
+    mock_request.return_value = (403, {"error": "You are not a server admin"})
+    assert matrix.purge_local_media(86400) == (False, "You are not a server admin")
+
+
+def test_configure_timers(matrix, mock_check_call, mock_host_service, mock_juju_unit):
+    """Test media purge and database maintenance timers are installed and removed to match the schedule config."""
+    timer_file = os.path.join(matrix.synapse_worker_service_dir, "matrix-purge-media-remote.timer")
+    matrix.configure_timers()
+    assert mock_check_call.call_count == 0
+    matrix.charm_config["purge-remote-media-schedule"] = "daily"
+    matrix.configure_timers()
+    assert mock_check_call.call_count == 1
+    with open(timer_file) as timer:
+        assert "OnCalendar=daily\n" in timer.readlines()
+    mock_host_service.assert_any_call("enable", "matrix-purge-media-remote.timer")
+    matrix.charm_config["purge-remote-media-schedule"] = ""
+    matrix.configure_timers()
+    assert mock_check_call.call_count == 2
+    assert not os.path.exists(timer_file)
+    matrix.charm_config["db-maintenance-schedule"] = "weekly"
+    matrix.configure_timers()
+    service_file = os.path.join(matrix.synapse_worker_service_dir, "matrix-db-maintenance.service")
+    with open(service_file) as service:
+        assert "Description=Vacuum and analyze the Matrix database\n" in service.readlines()
+    mock_host_service.assert_any_call("enable", "matrix-db-maintenance.timer")
+
+
+def test_run_db_maintenance(matrix, monkeypatch):
+    """Test tables are reported on then vacuumed and analyzed one at a time."""
+    mock_query = mock.Mock()
+    mock_query.side_effect = [
+        [
+            ("events", 900, 100, 1000, 3000, None, None),
+            ("receipts_linearized", 0, 0, 100, 100, None, None),
+        ],
+        [("receipts_linearized", "receipts_linearized_id")],
+        None,
+        None,
+    ]
+    monkeypatch.setattr(matrix, "pgsql_query", mock_query)
+    success, result = matrix.run_db_maintenance("events,receipts_linearized,missing")
+    assert success is True
+    assert mock_query.call_args_list[0][0][1] == (["events", "receipts_linearized", "missing"],)
+    assert "pgstatindex" in mock_query.call_args_list[1][0][0]
+    assert mock_query.call_args_list[2:] == [
+        mock.call('VACUUM (ANALYZE) "events";'),
+        mock.call('VACUUM (ANALYZE) "receipts_linearized";'),
+    ]
+    assert result["tables"]["events"]["dead-ratio"] == 0.1
+    assert result["tables"]["events"]["last-vacuum"] == "never"
+    assert result["tables"]["receipts_linearized"]["dead-ratio"] == 0.0
+    assert result["tables"]["receipts_linearized"]["bloated-indexes"] == ["receipts_linearized_id"]
+    assert result["vacuumed"] == ["events", "receipts_linearized"]
+    assert result["reindex"] == ["receipts_linearized"]
+    assert result["reindex-check"] == matrix.db_reindex_checks["leaf-density"]
+
+    mock_query.side_effect = [
+        [("events", 900, 100, 1000, 3000, None, None)],
+        "function pgstatindex(regclass) does not exist",
+    ]
+    success, result = matrix.run_db_maintenance("events", vacuum=False)
+    assert result["reindex"] == ["events"]
+    assert result["reindex-check"] == matrix.db_reindex_checks["size-ratio"]
+
+    mock_query.side_effect = [[("events", 900, 100, 1000, 3000, None, None)], [], "permission denied"]
+    assert matrix.run_db_maintenance("events") == (False, "Unable to vacuum events: permission denied")
+    mock_query.side_effect = None
+    mock_query.reset_mock()
+    assert matrix.run_db_maintenance("events; DROP TABLE users")[0] is False
+    assert mock_query.call_count == 0
+    matrix.charm_config["db-maintenance-tables"] = ""
+    assert matrix.get_db_maintenance_tables() == list(matrix.db_maintenance_tables)
+
+
+def test_register_user_api(matrix, monkeypatch):
+    """Test registering a user with the shared secret admin API."""
+    import hashlib
+    import hmac
+
+    mock_request = mock.Mock()
+    mock_request.side_effect = [
+        (200, {"nonce": "mocknonce"}),
+        (200, {"user_id": "@alice:mock.fqdn"}),
+    ]
+    monkeypatch.setattr(matrix, "admin_api_request", mock_request)
+    result = matrix.register_user_api("secret", "alice", "pw", admin=True)
+    assert result == (True, "@alice:mock.fqdn")
+    expected_mac = hmac.new(
+        key=b"secret", msg=b"mocknonce\x00alice\x00pw\x00admin", digestmod=hashlib.sha1
+    ).hexdigest()
+    assert mock_request.call_args == mock.call(
+        "POST",
+        "/_synapse/admin/v1/register",
+        {
+            "nonce": "mocknonce",
+            "username": "alice",
+            "password": "pw",
+            "admin": True,
+            "mac": expected_mac,
+        },
+    )
+
+    mock_request.side_effect = [
+        (200, {"nonce": "mocknonce"}),
+        (400, {"error": "User ID already taken."}),
+    ]
+    assert matrix.register_user_api("secret", "alice", "pw") == (False, "User ID already taken.")
+
+
+def test_register_users(matrix, monkeypatch):
+    """Test registering users concurrently."""
+    def mock_register(shared_secret, user, password=None, admin=False):
+        if user == "taken":
+            return False, "User ID already taken."
+        return True, "@{}:mock.fqdn".format(user)
+
+    monkeypatch.setattr(matrix, "register_user_api", mock_register)
+    results, duration = matrix.register_users(
+        [{"user": "alice"}, {"user": "taken"}, {"user": "bob"}], concurrency=2
+    )
+    assert [result["outcome"] for result in results] == ["success", "failure", "success"]
+    assert results[2]["message"] == "@bob:mock.fqdn"
+    assert duration >= 0
+
+
 def test_get_secret(matrix, mock_random):
     """Test secret generation."""
     matrix.kv.unset("shared-secret")
@@ -131,6 +431,152 @@ def test_get_token(matrix, mock_random):
     assert result == "mmmmmmmmmmmmmmmmmmmmmmmm"
 
 
+def test_leader_secrets(matrix, mock_leader, mock_random):
+    """Test the leader shares its secrets and other units wait for them."""
+    matrix.kv.set("shared-secret", "existingsecret")
+    assert matrix.get_shared_secret() == "existingsecret"
+    assert matrix.get_replication_secret() == "mmmmmmmmmmmmmmmmmmmmmmmm"
+    assert mock_leader.settings == {
+        "shared-secret": "existingsecret",
+        "replication-secret": "mmmmmmmmmmmmmmmmmmmmmmmm",
+    }
+
+    mock_leader.return_value = False
+    matrix._leadership = {}
+    assert matrix.get_token("admin_password") is None
+    mock_leader.settings["admin_password"] = "sharedpassword"
+    matrix._leadership = {}
+    assert matrix.get_token("admin_password") == "sharedpassword"
+
+
+def test_signing_key_shared(matrix, mock_leader):
+    """Test the leader shares its signing key and other units write it."""
+    with open(matrix.synapse_signing_key_file, "w") as key_file:
+        key_file.write("ed25519 a_mock leaderkey\n")
+    assert matrix.get_synapse_signing_key() == matrix.synapse_signing_key_file
+    assert mock_leader.settings["signing-key"] == "ed25519 a_mock leaderkey\n"
+
+    mock_leader.return_value = False
+    matrix._leadership = {}
+    os.remove(matrix.synapse_signing_key_file)
+    assert matrix.get_synapse_signing_key() == matrix.synapse_signing_key_file
+    with open(matrix.synapse_signing_key_file) as key_file:
+        assert key_file.read() == "ed25519 a_mock leaderkey\n"
+    mock_leader.settings.clear()
+    matrix._leadership = {}
+    assert matrix.get_synapse_signing_key() is None
+
+
+def test_worker_only_unit(matrix, mock_leader, mock_relations, monkeypatch):
+    """Test units other than the leader run only stateless workers without the main process."""
+    monkeypatch.setattr("lib_matrix.hookenv.local_unit", lambda: "matrix/2")
+    matrix.charm_config["workers"] = "synchrotron=2,federation_reader=1"
+    matrix.charm_config["federation-senders"] = 1
+    matrix.charm_config["event-persisters"] = 1
+    mock_relations.relation_ids["matrix-peers"] = ["matrix-peers:1"]
+    mock_relations.related_units["matrix-peers:1"] = ["matrix/0"]
+    assert matrix.get_replication_host() == "mock.fqdn"
+    assert mock_leader.settings["main-address"] == "mock.fqdn"
+
+    mock_leader.return_value = False
+    matrix._leadership = {}
+    assert matrix.get_unit_role() == "worker"
+    assert [worker["name"] for worker in matrix.get_workers()] == [
+        "synchrotron1-2",
+        "synchrotron2-2",
+        "federation_reader1-2",
+    ]
+    assert matrix.get_workers_of_type("federation_sender") == ["federation_sender1"]
+    assert list(matrix.get_instance_map()) == ["event_persister1"]
+    assert matrix.get_synapse_services() == [worker["service"] for worker in matrix.get_workers()]
+    assert matrix.get_replication_host() == "mock.fqdn"
+    assert matrix.get_replication_bind() == "::"
+    assert matrix.get_media_purge_schedule("remote") is None
+
+
+def test_main_unit_handover(matrix, mock_leader, mock_relations, mock_host_service_running):
+    """Test a new leader only runs the main process once the previous main unit has stopped it."""
+    assert matrix.is_main_unit() is True
+    assert mock_leader.settings["main-unit"] == "mocked"
+
+    mock_leader.settings["main-unit"] = "matrix/0"
+    matrix._leadership = {}
+    mock_relations.relation_ids["matrix-peers"] = ["matrix-peers:1"]
+    mock_relations.related_units["matrix-peers:1"] = ["matrix/0"]
+    mock_relations.relation_data["matrix/0"] = {"address": "10.0.0.1", "main-running": "true"}
+    assert matrix.is_main_unit() is False
+    assert matrix.get_unit_role() == "worker"
+    assert mock_leader.settings["main-handover"] == "mocked"
+    assert mock_leader.settings["main-unit"] == "matrix/0"
+
+    mock_relations.relation_data["matrix/0"]["main-running"] = "false"
+    matrix._leadership = {}
+    assert matrix.is_main_unit() is True
+    assert mock_leader.settings["main-unit"] == "mocked"
+
+    mock_leader.return_value = False
+    matrix._leadership = {}
+    mock_host_service_running.side_effect = None
+    mock_host_service_running.return_value = False
+    matrix.publish_peer_info()
+    assert mock_relations.call_args[0][1]["main-running"] == "false"
+
+
+def test_leadership_read_once_per_hook(matrix, mock_leader, monkeypatch):
+    """Test leadership and leader settings are read once however often they are used."""
+    from charmhelpers.core import hookenv
+
+    mock_leader_get = mock.Mock(side_effect=hookenv.leader_get)
+    monkeypatch.setattr("lib_matrix.hookenv.leader_get", mock_leader_get)
+    matrix.save_pgsql_conf(db)
+    matrix.charm_config["workers"] = "synchrotron=10"
+    assert matrix.render_configs() is True
+    for user in range(100):
+        matrix.get_user_id("user{}".format(user))
+    assert mock_leader.call_count == 1
+    assert mock_leader_get.call_count == 1
+    assert mock_leader.settings["server-name"] == "mock.fqdn"
+    assert matrix.leader_get("main-unit") == "mocked"
+
+
+def test_worker_only_unit_waits(matrix, mock_leader, mock_host_service):
+    """Test units other than the leader wait for secrets and a related Redis before rendering."""
+    matrix.save_pgsql_conf(db)
+    mock_leader.return_value = False
+    matrix._leadership = {}
+    assert matrix.render_synapse_config() is False
+    assert matrix.render_error == "Waiting for the leader to share secrets"
+
+    mock_leader.settings.update(
+        {
+            "server-name": "leader.fqdn",
+            "shared-secret": "shared",
+            "replication-secret": "replication",
+            "signing-key": "ed25519 a_mock leaderkey\n",
+        }
+    )
+    matrix._leadership = {}
+    matrix.charm_config["workers"] = "synchrotron=1"
+    assert matrix.render_synapse_config() is False
+    assert matrix.render_error == "Workers on this unit require a related Redis"
+
+    matrix.kv.set("redis_host", "redis.host")
+    matrix.kv.set("redis_port", 6379)
+    assert matrix.render_synapse_config() is True
+    with open(matrix.synapse_config) as config_file:
+        content = config_file.read()
+    assert "worker_replication_secret: replication\n" in content
+    assert 'server_name: "leader.fqdn"\n' in content
+    synapse_config = yaml.safe_load(content)
+    assert synapse_config["instance_map"] == {"main": {"host": "127.0.0.1", "port": 9093}}
+    assert "stream_writers" not in synapse_config
+    assert matrix.start_synapse() is True
+    assert mock_host_service.call_args_list[-2:] == [
+        mock.call("stop", matrix.synapse_service),
+        mock.call("disable", matrix.synapse_service),
+    ]
+
+
 def test_restart(matrix, mock_host_service):
     """Restart services."""
     matrix.synapse_service = "testservice"
@@ -139,6 +585,81 @@ def test_restart(matrix, mock_host_service):
     assert mock_host_service.call_count == 1
 
 
+def test_rolling_restart(matrix, mock_host_service, mock_health):
+    """Test workers are restarted one at a time by type, then the main process."""
+    matrix.charm_config["workers"] = "synchrotron=2,federation_reader=1"
+    assert matrix.rolling_restart() is True
+    assert mock_host_service.call_args_list == [
+        mock.call("restart", "matrix-synapse-worker-federation_reader1"),
+        mock.call("restart", "matrix-synapse-worker-synchrotron1"),
+        mock.call("restart", "matrix-synapse-worker-synchrotron2"),
+        mock.call("restart", matrix.synapse_service),
+    ]
+    assert mock_health.call_args_list[-1] == mock.call(matrix.admin_api_port)
+
+    mock_host_service.reset_mock()
+    mock_health.return_value = False
+    matrix.health_check_timeout = 0
+    assert matrix.rolling_restart() is False
+    assert mock_host_service.call_args_list == [
+        mock.call("restart", "matrix-synapse-worker-federation_reader1"),
+        mock.call("restart", matrix.synapse_service),
+    ]
+
+
+def test_render_configs_adds_workers(matrix, mock_check_call, mock_host_service, mock_health):
+    """Test adding workers restarts each process once, after worker configs are rendered."""
+    matrix.save_pgsql_conf(db)
+    assert matrix.render_configs() is True
+    mock_host_service.reset_mock()
+    matrix.charm_config["workers"] = "synchrotron=1"
+
+    def restart(action, name):
+        if name.startswith(matrix.synapse_worker_service_prefix):
+            assert os.path.exists(matrix.get_worker_unit_file("synchrotron1"))
+        return True
+
+    mock_host_service.side_effect = restart
+    assert matrix.render_configs() is True
+    assert mock_host_service.call_args_list == [
+        mock.call("restart", "matrix-synapse-worker-synchrotron1"),
+        mock.call("restart", matrix.synapse_service),
+    ]
+
+    mock_host_service.reset_mock()
+    mock_health.return_value = False
+    matrix.health_check_timeout = 0
+    matrix.charm_config["workers"] = "synchrotron=2"
+    assert matrix.render_configs() is False
+    assert matrix.render_error == "Synapse processes failed their health checks after restarting"
+
+
+def test_render_configs_retries_pending_restarts(matrix, mock_check_call, mock_host_service, mock_health):
+    """Test workers skipped after a failed health check are restarted by the next render."""
+    matrix.save_pgsql_conf(db)
+    matrix.charm_config["workers"] = "synchrotron=1,federation_reader=1"
+    assert matrix.render_configs() is True
+    assert matrix.has_pending_restarts() is False
+    mock_host_service.reset_mock()
+    matrix.health_check_timeout = 0
+    mock_health.side_effect = lambda port: port != 8084
+    matrix.charm_config["enable-metrics"] = True
+    assert matrix.render_configs() is False
+    assert mock_host_service.call_args_list == [
+        mock.call("restart", "matrix-synapse-worker-federation_reader1"),
+        mock.call("restart", matrix.synapse_service),
+    ]
+    assert matrix.has_pending_restarts() is True
+
+    mock_host_service.reset_mock()
+    mock_health.side_effect = None
+    assert matrix.render_configs() is True
+    assert mock_host_service.call_args_list == [
+        mock.call("restart", "matrix-synapse-worker-synchrotron1"),
+    ]
+    assert matrix.has_pending_restarts() is False
+
+
 def test_start_services(matrix, mock_host_service):
     """Configure and start services."""
     mock_host_service.reset_mock()
@@ -154,6 +675,445 @@ def test_start_services(matrix, mock_host_service):
     assert status is True
 
 
+def test_start_services_workers(matrix, mock_host_service):
+    """Start and enable services for each configured worker."""
+    matrix.charm_config["workers"] = "synchrotron=2"
+    mock_host_service.reset_mock()
+    status = matrix.start_services()
+    mock_host_service.assert_has_calls(
+        [
+            mock.call("start", "matrix-synapse-worker-synchrotron1"),
+            mock.call("enable", "matrix-synapse-worker-synchrotron1"),
+            mock.call("start", "matrix-synapse-worker-synchrotron2"),
+            mock.call("enable", "matrix-synapse-worker-synchrotron2"),
+        ],
+        any_order=False,
+    )
+    assert mock_host_service.call_count == 6
+    assert status is True
+
+
+def test_get_workers(matrix):
+    """Test parsing of the workers config into worker instances."""
+    assert matrix.get_workers() == []
+    matrix.charm_config["workers"] = "synchrotron=2,federation_reader,bogus=1,client_reader=x"
+    workers = matrix.get_workers()
+    assert [worker["name"] for worker in workers] == [
+        "synchrotron1",
+        "synchrotron2",
+        "federation_reader1",
+    ]
+    assert [worker["port"] for worker in workers] == [8083, 8084, 8085]
+    assert workers[0]["resources"] == ["client"]
+    assert workers[2]["resources"] == ["federation"]
+    assert workers[0]["service"] == "matrix-synapse-worker-synchrotron1"
+    assert workers[0]["config"] == os.path.join(
+        matrix.synapse_worker_conf_dir, "synchrotron1.yaml"
+    )
+
+
+def test_render_worker_configs(matrix, mock_check_call, mock_host_service):
+    """Test rendering and removal of worker configuration and service units."""
+    matrix.charm_config["workers"] = "synchrotron=2"
+    assert matrix.render_worker_configs() is True
+    assert mock_check_call.call_count == 1
+    with open(os.path.join(matrix.synapse_worker_conf_dir, "synchrotron2.yaml")) as worker_file:
+        content = worker_file.read()
+    assert 'worker_name: "synchrotron2"' in content
+    assert "port: 8084" in content
+    assert os.path.exists(matrix.get_worker_unit_file("synchrotron1"))
+
+    mock_check_call.reset_mock()
+    matrix.render_worker_configs()
+    assert mock_check_call.call_count == 0
+
+    matrix.charm_config["workers"] = "synchrotron=1"
+    mock_host_service.reset_mock()
+    matrix.render_worker_configs()
+    assert mock_check_call.call_count == 1
+    mock_host_service.assert_any_call("stop", "matrix-synapse-worker-synchrotron2")
+    assert not os.path.exists(matrix.get_worker_unit_file("synchrotron2"))
+    assert not os.path.exists(os.path.join(matrix.synapse_worker_conf_dir, "synchrotron2.yaml"))
+    assert matrix.kv.get("synapse_workers") == ["synchrotron1"]
+
+
+def test_configure_proxy_workers(matrix, mock_relations):
+    """Test URL paths are routed to the workers serving them."""
+    import re
+
+    mock_relations.relation_ids["reverseproxy"] = ["reverseproxy:1"]
+    mock_relations.related_units["reverseproxy:1"] = ["haproxy/0"]
+    mock_relations.relation_data["haproxy/0"] = {"features": "urlregex,balance"}
+    mock_proxy = mock.Mock()
+    matrix.charm_config["enable-tls"] = False
+    matrix.charm_config["enable-federation"] = False
+    matrix.charm_config["external-domain"] = "mock.external"
+    matrix.charm_config["workers"] = "synchrotron=2,media_repository=1"
+    matrix.configure_proxy(mock_proxy)
+    proxy_config = mock_proxy.configure.call_args[0][0]
+    assert len(proxy_config) == 7
+    assert proxy_config[0]["internal_port"] == 8008
+    sync_routes = proxy_config[1:3]
+    assert [route["internal_port"] for route in sync_routes] == [8083, 8084]
+    assert all(route["group_id"] == "mock.external-synchrotron-0" for route in sync_routes)
+    assert all(route["balance"] == "hdr(Authorization)" for route in sync_routes)
+    assert re.match(sync_routes[0]["urlregex"], "/_matrix/client/r0/sync")
+    assert re.match(sync_routes[0]["urlregex"], "/_matrix/client/v3/rooms/!a:b/initialSync")
+    assert re.match(sync_routes[0]["urlregex"], "/_matrix/client/r0/sync?since=s1&timeout=30000")
+    assert not re.match(sync_routes[0]["urlregex"], "/_matrix/client/r0/rooms/!a:b/messages")
+    assert proxy_config[3]["urlbase"] == "/_matrix/media/"
+    assert proxy_config[3]["internal_port"] == 8085
+    assert [route.get("urlbase") for route in proxy_config[4:6]] == [
+        "/_matrix/client/v1/media/",
+        "/_matrix/federation/v1/media/",
+    ]
+    assert proxy_config[6]["group_id"] == "mock.external-media_repository-3"
+
+    mock_relations.relation_data["haproxy/0"] = {"features": "balance"}
+    matrix.configure_proxy(mock_proxy)
+    proxy_config = mock_proxy.configure.call_args[0][0]
+    assert [entry.get("urlbase") for entry in proxy_config[1:]] == [
+        "/_matrix/media/",
+        "/_matrix/client/v1/media/",
+        "/_matrix/federation/v1/media/",
+    ]
+    assert all("urlregex" not in entry for entry in proxy_config)
+
+
+def test_configure_proxy_peers(matrix, mock_relations, mock_leader):
+    """Test the main unit publishes backends for the workers of every peer unit."""
+    mock_proxy = mock.Mock()
+    matrix.charm_config["external-domain"] = "mock.external"
+    matrix.charm_config["enable-federation"] = False
+    matrix.charm_config["workers"] = "synchrotron=1"
+    mock_relations.relation_ids["matrix-peers"] = ["matrix-peers:1"]
+    mock_relations.related_units["matrix-peers:1"] = ["matrix/1", "matrix/2"]
+    mock_relations.relation_ids["reverseproxy"] = ["reverseproxy:1"]
+    mock_relations.related_units["reverseproxy:1"] = ["haproxy/0"]
+    mock_relations.relation_data["haproxy/0"] = {"features": "urlregex,balance"}
+    mock_relations.relation_data["matrix/1"] = {
+        "address": "10.0.0.2",
+        "role": "worker",
+        "workers": '[{"type": "synchrotron", "port": 8083}]',
+    }
+    matrix.publish_peer_info()
+    assert mock_relations.call_args[0][0] == "matrix-peers:1"
+    assert mock_relations.call_args[0][1]["role"] == "main"
+    assert [unit["unit"] for unit in matrix.get_peer_units()] == ["mocked", "matrix/1"]
+
+    matrix.configure_proxy(mock_proxy)
+    proxy_config = mock_proxy.configure.call_args[0][0]
+    assert [(entry["internal_host"], entry["internal_port"]) for entry in proxy_config] == [
+        ("mock.fqdn", 8008),
+        ("mock.fqdn", 8083),
+        ("10.0.0.2", 8083),
+    ]
+    assert proxy_config[1]["group_id"] == proxy_config[2]["group_id"]
+    assert all(entry["check"] for entry in proxy_config)
+    assert all(entry["check_path"] == "/health" for entry in proxy_config)
+
+    mock_leader.return_value = False
+    matrix._leadership = {}
+    matrix.configure_proxy(mock_proxy)
+    assert mock_proxy.configure.call_args == mock.call([])
+
+
+def test_unroutable_worker_status(matrix, mock_relations, mock_status_set):
+    """Test the active status names the workers a proxy without urlregex support can not route to."""
+    matrix.save_pgsql_conf(db)
+    matrix.charm_config["workers"] = "synchrotron=2,federation_inbound=1,media_repository=1"
+    assert matrix.get_unroutable_worker_types() == ["federation_inbound", "synchrotron"]
+    assert matrix.configure() is True
+    assert mock_status_set.call_args == mock.call(
+        "active",
+        matrix.HEALTHY
+        + ", reverse proxy can not route to federation_inbound, synchrotron workers without urlregex",
+    )
+    mock_relations.relation_ids["reverseproxy"] = ["reverseproxy:1"]
+    mock_relations.related_units["reverseproxy:1"] = ["haproxy/0"]
+    mock_relations.relation_data["haproxy/0"] = {"features": "urlregex"}
+    assert matrix.get_unroutable_worker_types() == []
+    assert matrix.configure() is True
+    assert mock_status_set.call_args == mock.call("active", matrix.HEALTHY)
+
+
+def test_worker_routes(matrix):
+    """Test the routed paths for client workers match the endpoints they serve."""
+    import re
+
+    routes = matrix.synapse_worker_routes
+    for worker_type, request_path in (
+        ("client_reader", "/_matrix/client/r0/rooms/!a:b/messages"),
+        ("event_creator", "/_matrix/client/v3/rooms/!a:b/send/m.room.message/1"),
+        ("federation_inbound", "/_matrix/federation/v1/send/1234"),
+        ("user_dir", "/_matrix/client/r0/user_directory/search"),
+        ("client_reader", "/_matrix/client/r0/publicRooms?limit=10"),
+        ("typing_writer", "/_matrix/client/r0/rooms/!a:b/typing/@c:d"),
+        ("receipts_writer", "/_matrix/client/r0/rooms/!a:b/receipt/m.read/$e"),
+    ):
+        assert any(
+            re.match(route["urlregex"], request_path)
+            for route in routes[worker_type]
+            if "urlregex" in route
+        ), "{} does not route {}".format(worker_type, request_path)
+
+
+def test_render_media_config(matrix, tmpdir):
+    """Test the main process hands media to media repository workers."""
+    matrix.save_pgsql_conf(db)
+    matrix.charm_config["media-store-path"] = "/srv/media"
+    matrix.render_configs()
+    with open(matrix.synapse_config) as config_file:
+        content = config_file.readlines()
+    assert 'media_store_path: "/srv/media"\n' in content
+    assert 'max_upload_size: "50M"\n' in content
+    assert "enable_media_repo: false\n" not in content
+    matrix.charm_config["workers"] = "media_repository=1"
+    matrix.render_configs()
+    with open(matrix.synapse_config) as config_file:
+        content = config_file.readlines()
+    assert "enable_media_repo: false\n" in content
+    assert 'media_instance_running_background_jobs: "media_repository1"\n' in content
+    with open(os.path.join(matrix.synapse_worker_conf_dir, "media_repository1.yaml")) as worker_file:
+        content = worker_file.readlines()
+    assert "      - names: [media]\n" in content
+    assert 'worker_log_config: "{}"\n'.format(matrix.synapse_log_config) in content
+
+
+def test_storage_paths(matrix, monkeypatch):
+    """Test media and uploads paths follow attached storage and config."""
+    assert matrix.get_media_store_path() == os.path.join(matrix.synapse_conf_dir, "media_store")
+    assert matrix.get_uploads_path() == os.path.join(matrix.synapse_conf_dir, "uploads")
+    monkeypatch.setattr(
+        "lib_matrix.hookenv.storage_get", lambda attribute, storage_id: "/srv/storage"
+    )
+    matrix.save_storage_location("media")
+    matrix.save_storage_location("uploads")
+    assert matrix.get_media_store_path() == "/srv/storage"
+    assert matrix.get_uploads_path() == "/srv/storage"
+    matrix.charm_config["uploads-tmpfs-size"] = "1G"
+    assert matrix.get_uploads_path() == matrix.uploads_tmpfs_path
+    matrix.remove_storage_location("media")
+    assert matrix.get_media_store_path() == os.path.join(matrix.synapse_conf_dir, "media_store")
+
+
+def test_configure_uploads_tmpfs(matrix, monkeypatch):
+    """Test the uploads tmpfs is mounted, resized and removed as configured."""
+    mounts = []
+    mock_mount = mock.Mock(side_effect=lambda device, mountpoint, **kwargs: mounts.append([mountpoint, device]))
+    mock_umount = mock.Mock(side_effect=lambda mountpoint, persist: mounts.clear())
+    monkeypatch.setattr("lib_matrix.host.mounts", lambda: mounts)
+    monkeypatch.setattr("lib_matrix.host.mount", mock_mount)
+    monkeypatch.setattr("lib_matrix.host.umount", mock_umount)
+    monkeypatch.setattr("lib_matrix.host.mkdir", mock.Mock())
+    matrix.configure_uploads_tmpfs()
+    assert mock_mount.call_count == 0
+    matrix.charm_config["uploads-tmpfs-size"] = "1G"
+    matrix.configure_uploads_tmpfs()
+    matrix.configure_uploads_tmpfs()
+    assert mock_mount.call_count == 1
+    assert mock_mount.call_args[1]["options"] == "size=1G,mode=0700"
+    matrix.charm_config["uploads-tmpfs-size"] = "2G"
+    matrix.configure_uploads_tmpfs()
+    assert mock_umount.call_count == 1
+    assert mock_mount.call_count == 2
+    matrix.charm_config["uploads-tmpfs-size"] = ""
+    matrix.configure_uploads_tmpfs()
+    assert mock_umount.call_count == 2
+    assert mounts == []
+
+
+def test_federation_senders(matrix):
+    """Test federation sender workers are added from their count and hand over outbound federation."""
+    matrix.save_pgsql_conf(db)
+    matrix.charm_config["workers"] = "synchrotron=1"
+    matrix.charm_config["federation-senders"] = 2
+    workers = matrix.get_workers()
+    assert [worker["name"] for worker in workers] == [
+        "synchrotron1",
+        "federation_sender1",
+        "federation_sender2",
+    ]
+    assert workers[1]["resources"] == ["health"]
+    assert workers[2]["port"] == 8085
+    matrix.render_configs()
+    with open(matrix.synapse_config) as config_file:
+        synapse_config = yaml.safe_load(config_file)
+    assert synapse_config["send_federation"] is False
+    assert synapse_config["federation_sender_instances"] == ["federation_sender1", "federation_sender2"]
+    matrix.charm_config["workers"] = "federation_sender=4"
+    assert matrix.get_workers_of_type("federation_sender") == ["federation_sender1", "federation_sender2"]
+
+
+def test_stream_writers(matrix, mock_relations):
+    """Test event persisters and stream writers are added to the instance map and stream writers."""
+    matrix.save_pgsql_conf(db)
+    mock_relations.relation_ids["reverseproxy"] = ["reverseproxy:1"]
+    mock_relations.related_units["reverseproxy:1"] = ["haproxy/0"]
+    mock_relations.relation_data["haproxy/0"] = {"features": "urlregex"}
+    matrix.charm_config["workers"] = "synchrotron=1"
+    matrix.charm_config["event-persisters"] = 2
+    matrix.charm_config["stream-writers"] = "typing=2,receipts=2,unknown"
+    assert matrix.get_stream_writer_counts() == [("typing", 1), ("receipts", 2)]
+    assert matrix.get_instance_map() == {
+        "event_persister1": 9201,
+        "event_persister2": 9202,
+        "typing_writer1": 9203,
+        "receipts_writer1": 9204,
+        "receipts_writer2": 9205,
+    }
+    matrix.render_configs()
+    with open(matrix.synapse_config) as config_file:
+        synapse_config = yaml.safe_load(config_file)
+    assert synapse_config["instance_map"]["main"] == {"host": "127.0.0.1", "port": 9093}
+    assert synapse_config["instance_map"]["typing_writer1"] == {"host": "127.0.0.1", "port": 9203}
+    assert synapse_config["stream_writers"] == {
+        "events": ["event_persister1", "event_persister2"],
+        "typing": ["typing_writer1"],
+        "receipts": ["receipts_writer1", "receipts_writer2"],
+    }
+    with open(os.path.join(matrix.synapse_worker_conf_dir, "typing_writer1.yaml")) as worker_file:
+        worker_config = yaml.safe_load(worker_file)
+    assert worker_config["worker_listeners"][0]["resources"][0]["names"] == ["client"]
+    assert worker_config["worker_listeners"][1] == {
+        "port": 9203,
+        "bind_addresses": ["127.0.0.1"],
+        "type": "http",
+        "resources": [{"names": ["replication"]}],
+    }
+    with open(os.path.join(matrix.synapse_worker_conf_dir, "synchrotron1.yaml")) as worker_file:
+        assert len(yaml.safe_load(worker_file)["worker_listeners"]) == 1
+
+
+def test_stream_writers_require_urlregex(matrix, mock_relations, mock_status_set):
+    """Test stream writers block the unit unless the reverse proxy can route their endpoints."""
+    matrix.save_pgsql_conf(db)
+    matrix.charm_config["event-persisters"] = 1
+    assert matrix.render_synapse_config() is True
+    matrix.charm_config["stream-writers"] = "typing"
+    assert matrix.configure() is False
+    assert mock_status_set.call_args == mock.call(
+        "blocked", "stream-writers require a reverse proxy with urlregex support"
+    )
+    mock_relations.relation_ids["reverseproxy"] = ["reverseproxy:1"]
+    mock_relations.related_units["reverseproxy:1"] = ["haproxy/0"]
+    mock_relations.relation_data["haproxy/0"] = {"features": "balance"}
+    assert matrix.render_synapse_config() is False
+    mock_relations.relation_data["haproxy/0"] = {"features": "urlregex,balance"}
+    assert matrix.render_synapse_config() is True
+
+
+def test_background_workers(matrix):
+    """Test pushers, appservice, user directory and background task workers are handed their work."""
+    matrix.save_pgsql_conf(db)
+    matrix.render_configs()
+    with open(matrix.synapse_config) as config_file:
+        synapse_config = yaml.safe_load(config_file)
+    for key in (
+        "pusher_instances",
+        "notify_appservices_from_worker",
+        "update_user_directory_from_worker",
+        "run_background_tasks_on",
+    ):
+        assert key not in synapse_config
+    matrix.charm_config["pushers"] = 2
+    matrix.charm_config["appservice-worker"] = True
+    matrix.charm_config["user-directory-worker"] = True
+    matrix.charm_config["background-worker"] = True
+    assert [worker["name"] for worker in matrix.get_workers()] == [
+        "pusher1",
+        "pusher2",
+        "appservice1",
+        "user_dir1",
+        "background_worker1",
+    ]
+    matrix.render_configs()
+    with open(matrix.synapse_config) as config_file:
+        synapse_config = yaml.safe_load(config_file)
+    assert synapse_config["pusher_instances"] == ["pusher1", "pusher2"]
+    assert synapse_config["notify_appservices_from_worker"] == "appservice1"
+    assert synapse_config["update_user_directory_from_worker"] == "user_dir1"
+    assert synapse_config["run_background_tasks_on"] == "background_worker1"
+
+
+def test_save_redis_conf(matrix, mock_redis):
+    """Test saving and removing related Redis configuration."""
+    assert matrix.redis_related() is False
+    matrix.save_redis_conf(mock_redis)
+    assert matrix.redis_related() is True
+    assert matrix.get_redis_config() == {
+        "host": "redis.mock",
+        "port": 6380,
+        "password": "redispass",
+    }
+    matrix.remove_redis_conf()
+    assert matrix.redis_related() is False
+
+
+def test_get_redis_config(matrix, mock_redis):
+    """Test Redis is only used for replication when workers are configured or Redis is related."""
+    assert matrix.get_redis_config() is None
+    matrix.charm_config["workers"] = "synchrotron=1"
+    assert matrix.get_redis_config() == {
+        "host": "127.0.0.1",
+        "port": 6379,
+        "password": None,
+    }
+    matrix.save_redis_conf(mock_redis)
+    assert matrix.get_redis_config()["host"] == "redis.mock"
+
+
+def test_configure_local_redis(matrix, mock_fetch, mock_host_service, mock_redis):
+    """Test the local Redis fallback is installed, started and stopped as required."""
+    assert matrix.configure_local_redis() is True
+    assert mock_fetch.call_count == 0
+
+    matrix.charm_config["workers"] = "synchrotron=1"
+    assert matrix.configure_local_redis() is True
+    mock_fetch.assert_called_once_with(["redis-server"], fatal=True)
+    mock_host_service.assert_any_call("start", "redis-server")
+    matrix.configure_local_redis()
+    assert mock_fetch.call_count == 1
+
+    mock_host_service.reset_mock()
+    matrix.save_redis_conf(mock_redis)
+    assert matrix.configure_local_redis() is True
+    mock_host_service.assert_any_call("stop", "redis-server")
+    assert matrix.kv.get("local_redis") is False
+
+
+def test_get_per_cache_factors(matrix):
+    """Test parsing of per cache factors."""
+    assert matrix.get_per_cache_factors() == {}
+    matrix.charm_config["per-cache-factors"] = "get_users_in_room=8,stateGroupCache=4,bogus=x"
+    assert matrix.get_per_cache_factors() == {
+        "get_users_in_room": 8.0,
+        "stateGroupCache": 4.0,
+    }
+
+
+def test_get_cache_factor(matrix, monkeypatch):
+    """Test the autotuned cache factor is sized from memory split across synapse processes."""
+    assert matrix.get_cache_factor() == 2.0
+    monkeypatch.setattr(matrix, "get_physical_memory", lambda: 8192)
+    matrix.charm_config["cache-autotuning"] = True
+    assert matrix.get_cache_factor() == 3.2
+    matrix.charm_config["workers"] = "synchrotron=3"
+    assert matrix.get_cache_factor() == 0.8
+    matrix.charm_config["workers"] = "synchrotron=8"
+    assert matrix.get_cache_factor() == 0.5
+
+
+def test_render_cache_autotuning(matrix, monkeypatch):
+    """Test the autotuned cache factor is rendered as the global cache factor."""
+    matrix.save_pgsql_conf(db)
+    monkeypatch.setattr(matrix, "get_physical_memory", lambda: 16384)
+    matrix.charm_config["cache-autotuning"] = True
+    assert matrix.render_synapse_config() is True
+    with open(matrix.synapse_config) as config_file:
+        assert yaml.safe_load(config_file)["caches"]["global_factor"] == 6.4
+
+
 def test_get_server_name(matrix, mock_socket):
     """Test get_server_name."""
     result = matrix.get_server_name()
@@ -163,6 +1123,21 @@ def test_get_server_name(matrix, mock_socket):
     assert result == "manualmockhost"
 
 
+def test_server_name_shared(matrix, mock_socket, mock_leader):
+    """Test units other than the leader use the FQDN shared by the leader as server name."""
+    assert matrix.get_server_name() == "mock.fqdn"
+    assert mock_leader.settings["server-name"] == "mock.fqdn"
+    mock_leader.return_value = False
+    mock_leader.settings["server-name"] = "leader.fqdn"
+    matrix._leadership = {}
+    assert matrix.get_server_name() == "leader.fqdn"
+    mock_leader.settings.clear()
+    matrix._leadership = {}
+    assert matrix.get_server_name() is None
+    assert matrix.get_cluster_context() is None
+    assert matrix.render_error == "Waiting for the leader to share secrets"
+
+
 def test_baseurl(matrix):
     """Test the get_public_baseurl function."""
     matrix.charm_config["enable-tls"] = False
@@ -214,6 +1189,8 @@ def test_configure_proxy(matrix):
                 "internal_host": "10.10.10.10",
                 "internal_port": 8008,
                 "subdomain": "mock.external",
+                "check": True,
+                "check_path": "/health",
             }
         ]
     )
@@ -234,6 +1211,8 @@ def test_configure_proxy(matrix):
                 "internal_host": "10.10.10.10",
                 "internal_port": 8008,
                 "subdomain": "mock.external",
+                "check": True,
+                "check_path": "/health",
             }
         ]
     )
@@ -254,6 +1233,8 @@ def test_configure_proxy(matrix):
                 "internal_host": "mock.fqdn",
                 "internal_port": 8008,
                 "subdomain": "mock.fqdn",
+                "check": True,
+                "check_path": "/health",
             }
         ]
     )
@@ -273,6 +1254,8 @@ def test_configure_proxy(matrix):
                 "internal_host": "mock.fqdn",
                 "internal_port": 8008,
                 "subdomain": "matrix.mockhost",
+                "check": True,
+                "check_path": "/health",
             }
         ]
     )
@@ -292,6 +1275,8 @@ def test_configure_proxy(matrix):
                 "internal_host": "mock.fqdn",
                 "internal_port": 8008,
                 "subdomain": "mock.fqdn",
+                "check": True,
+                "check_path": "/health",
             }
         ]
     )
@@ -312,6 +1297,8 @@ def test_configure_proxy(matrix):
                 "internal_host": "mock.fqdn",
                 "internal_port": 8008,
                 "subdomain": "manual.mock.host",
+                "check": True,
+                "check_path": "/health",
             }
         ]
     )
@@ -332,6 +1319,8 @@ def test_configure_proxy(matrix):
                 "internal_host": "mock.fqdn",
                 "internal_port": 8008,
                 "subdomain": "matrix.manual.mock.host",
+                "check": True,
+                "check_path": "/health",
             }
         ]
     )
@@ -352,12 +1341,15 @@ def test_configure_proxy(matrix):
                 "internal_host": "mock.fqdn",
                 "internal_port": 8008,
                 "subdomain": "mock.fqdn",
+                "check": True,
+                "check_path": "/health",
             },
             {
                 "mode": "tcp+tls",
                 "external_port": 8448,
                 "internal_host": "mock.fqdn",
                 "internal_port": 8448,
+                "check": True,
             }
         ]
     )
@@ -378,12 +1370,15 @@ def test_configure_proxy(matrix):
                 "internal_host": "mock.fqdn",
                 "internal_port": 8008,
                 "subdomain": "manual.mock.host",
+                "check": True,
+                "check_path": "/health",
             },
             {
                 "mode": "tcp+tls",
                 "external_port": 8448,
                 "internal_host": "mock.fqdn",
                 "internal_port": 8448,
+                "check": True,
             }
         ]
     )
@@ -404,12 +1399,15 @@ def test_configure_proxy(matrix):
                 "internal_host": "mock.fqdn",
                 "internal_port": 8008,
                 "subdomain": "matrix.manual.mock.host",
+                "check": True,
+                "check_path": "/health",
             },
             {
                 "mode": "tcp+tls",
                 "external_port": 8448,
                 "internal_host": "mock.fqdn",
                 "internal_port": 8448,
+                "check": True,
             }
         ]
     )
@@ -431,18 +1429,22 @@ def test_configure_proxy(matrix):
                 "internal_host": "mock.fqdn",
                 "internal_port": 8008,
                 "subdomain": "matrix.manual.mock.host",
+                "check": True,
+                "check_path": "/health",
             },
             {
                 "mode": "tcp+tls",
                 "external_port": 8448,
                 "internal_host": "mock.fqdn",
                 "internal_port": 8448,
+                "check": True,
             },
             {
                 "mode": "tcp+tls",
                 "external_port": 6697,
                 "internal_host": "mock.fqdn",
                 "internal_port": 6667,
+                "check": True,
             },
         ]
     )
@@ -460,23 +1462,56 @@ def test_configure_proxy(matrix):
                 "internal_host": "mock.fqdn",
                 "internal_port": 8008,
                 "subdomain": "matrix.manual.mock.host",
+                "check": True,
+                "check_path": "/health",
             },
             {
                 "mode": "tcp",
                 "external_port": 8448,
                 "internal_host": "mock.fqdn",
                 "internal_port": 8448,
+                "check": True,
             },
             {
                 "mode": "tcp",
                 "external_port": 6667,
                 "internal_host": "mock.fqdn",
                 "internal_port": 6667,
+                "check": True,
             },
         ]
     )
 
 
+def test_get_metrics_targets(matrix, mock_juju_unit):
+    """Test metrics targets are listed for the main process and each worker."""
+    assert matrix.get_metrics_targets() == []
+    matrix.charm_config["enable-metrics"] = True
+    matrix.charm_config["workers"] = "synchrotron=2"
+    assert matrix.get_metrics_targets() == [
+        {"targets": ["mock.fqdn:9000"], "labels": {"unit": "mocked", "worker": "main"}},
+        {"targets": ["mock.fqdn:9101"], "labels": {"unit": "mocked", "worker": "synchrotron1"}},
+        {"targets": ["mock.fqdn:9102"], "labels": {"unit": "mocked", "worker": "synchrotron2"}},
+    ]
+
+
+def test_publish_metrics_targets(matrix, mock_juju_unit, mock_relations):
+    """Test metrics targets are published on each prometheus relation."""
+    import json
+
+    matrix.publish_metrics_targets()
+    assert mock_relations.call_count == 0
+    mock_relations.relation_ids["prometheus"] = ["prometheus:1"]
+    matrix.charm_config["enable-metrics"] = True
+    matrix.publish_metrics_targets()
+    relation_id, data = mock_relations.call_args[0]
+    assert relation_id == "prometheus:1"
+    job = json.loads(data["request_matrix-synapse"])
+    assert job["job_name"] == "matrix-synapse"
+    assert job["job_data"]["metrics_path"] == "/_synapse/metrics"
+    assert job["job_data"]["static_configs"][0]["targets"] == ["mock.fqdn:9000"]
+
+
 def test_remove_proxy(matrix):
     """Test removal of reverse proxy."""
     matrix.remove_proxy_config()
@@ -549,6 +1584,71 @@ def test_get_internal_host(matrix):
     assert matrix.get_internal_host() == "mock.fqdn"
 
 
+def test_resolve_once_per_hook(matrix, monkeypatch):
+    """Test names are resolved once per hook and shared between getters."""
+    mock_getfqdn = mock.Mock(return_value="mock.fqdn")
+    mock_gethostbyname = mock.Mock(return_value="10.10.10.10")
+    monkeypatch.setattr("lib_matrix.socket.getfqdn", mock_getfqdn)
+    monkeypatch.setattr("lib_matrix.socket.gethostbyname", mock_gethostbyname)
+    matrix._resolved = {}
+    matrix.charm_config["prefer-internal-ip"] = True
+    assert matrix.get_internal_host() == "10.10.10.10"
+    assert matrix.get_internal_url() == "http://10.10.10.10:8008"
+    assert matrix.get_server_name() == "mock.fqdn"
+    matrix.configure_proxy(mock.Mock())
+    assert mock_getfqdn.call_count == 1
+    assert mock_gethostbyname.call_count == 1
+    assert matrix.kv.get("resolved_ip")["value"] == "10.10.10.10"
+
+
+def test_resolve_fallback(matrix, monkeypatch):
+    """Test previously resolved values are used within the TTL when resolution fails."""
+    import socket
+
+    mock_gethostbyname = mock.Mock(side_effect=socket.gaierror("mocked DNS failure"))
+    monkeypatch.setattr("lib_matrix.socket.gethostbyname", mock_gethostbyname)
+    with pytest.raises(socket.gaierror):
+        matrix.get_internal_ip()
+
+    matrix.kv.set("resolved_ip", {"value": "10.10.10.11", "time": time.time()})
+    assert matrix.get_internal_ip() == "10.10.10.11"
+
+    matrix._resolved = {}
+    matrix.kv.set("resolved_ip", {"value": "10.10.10.11", "time": time.time() - matrix.resolution_ttl - 1})
+    with pytest.raises(socket.gaierror):
+        matrix.get_internal_ip()
+
+
+def test_resolve_fqdn_fallback(matrix, monkeypatch):
+    """Test a bare hostname from getfqdn is treated as a failed lookup."""
+    monkeypatch.setattr("lib_matrix.socket.getfqdn", lambda: "mockhost")
+    monkeypatch.setattr("lib_matrix.socket.gethostname", lambda: "mockhost")
+    matrix._resolved = {}
+    matrix.kv.set("resolved_fqdn", {"value": "mock.fqdn", "time": time.time()})
+    assert matrix.get_fqdn() == "mock.fqdn"
+
+    matrix._resolved = {}
+    matrix.kv.unset("resolved_fqdn")
+    assert matrix.get_fqdn() == "mockhost"
+    assert matrix.kv.get("resolved_fqdn") is None
+
+
+def test_server_name_not_shared_unresolved(matrix, mock_leader, monkeypatch):
+    """Test the leader does not share the hostname as server name while the FQDN does not resolve."""
+    monkeypatch.setattr("lib_matrix.socket.getfqdn", lambda: "mockhost")
+    monkeypatch.setattr("lib_matrix.socket.gethostname", lambda: "mockhost")
+    matrix._resolved = {}
+    assert matrix.get_server_name() is None
+    assert "server-name" not in mock_leader.settings
+    assert matrix.get_cluster_context() is None
+    assert matrix.render_error == "Unable to resolve the FQDN to use as server name, set server-name"
+
+    monkeypatch.setattr("lib_matrix.socket.getfqdn", lambda: "mock.fqdn")
+    matrix._resolved = {}
+    assert matrix.get_server_name() == "mock.fqdn"
+    assert mock_leader.settings["server-name"] == "mock.fqdn"
+
+
 def test_render_synapse_config(matrix, tmpdir):
     """Test rendering of configuration for the homeserver."""
     path = tmpdir.join("homeserver.yaml")
@@ -563,6 +1663,188 @@ def test_render_synapse_config(matrix, tmpdir):
         content = config_file.readlines()
     print(content)
     assert b'server_name: "manual.mock.host"\n' in content
+    assert 'log_config: "{}"\n'.format(matrix.synapse_log_config).encode() in content
+    with open(matrix.synapse_log_config) as log_config:
+        assert "  level: INFO\n" in log_config.readlines()
+    matrix.charm_config["log-level"] = "verbose"
+    assert matrix.render_synapse_config() is False
+    assert matrix.render_error == "invalid log-level VERBOSE, expected one of DEBUG, INFO, WARNING, ERROR"
+    matrix.charm_config["log-level"] = "warning"
+    assert matrix.render_synapse_config() is True
+    with open(matrix.synapse_log_config) as log_config:
+        assert "  level: WARNING\n" in log_config.readlines()
+    assert b"      - names: [replication]\n" not in content
+    assert b"  global_factor: 2.0\n" in content
+    assert b"    cp_max: 10\n" in content
+    assert b"  txn_limit: 0\n" not in content
+    assert b"bcrypt_rounds: 12\n" in content
+    assert b"enable_metrics: False\n" in content
+    assert b"    type: metrics\n" not in content
+    assert b"  cache_autotuning:\n" not in content
+    matrix.charm_config["per-cache-factors"] = "get_users_in_room=8"
+    matrix.render_configs()
+    with open(matrix.synapse_config, "rb") as config_file:
+        content = config_file.readlines()
+    assert b"    get_users_in_room: 8.0\n" in content
+    matrix.charm_config["workers"] = "synchrotron=1"
+    matrix.render_configs()
+    with open(matrix.synapse_config, "rb") as config_file:
+        content = config_file.readlines()
+    assert b"      - names: [replication]\n" in content
+    assert b"  host: 127.0.0.1\n" in content
+    with open(os.path.join(matrix.synapse_worker_conf_dir, "synchrotron1.yaml"), "rb") as worker_file:
+        assert b"redis:\n" in worker_file.readlines()
+    matrix.charm_config["enable-metrics"] = True
+    matrix.render_configs()
+    with open(matrix.synapse_config, "rb") as config_file:
+        content = config_file.readlines()
+    assert b"  - port: 9000\n" in content
+    assert b"enable_metrics: True\n" in content
+    with open(os.path.join(matrix.synapse_worker_conf_dir, "synchrotron1.yaml"), "rb") as worker_file:
+        assert b"  - port: 9101\n" in worker_file.readlines()
+
+
+def test_get_changed_keys(matrix):
+    """Test changed keys are found in nested configuration."""
+    previous = {"report_stats": False, "caches": {"global_factor": 1.0}, "listeners": [1]}
+    current = {"report_stats": True, "caches": {"global_factor": 2.0}, "listeners": [1]}
+    assert matrix.get_changed_keys(previous, current) == ["caches.global_factor", "report_stats"]
+    assert matrix.get_changed_keys(previous, dict(previous)) == []
+    assert matrix.get_change_action("caches.per_cache_factors.get_users_in_room") == "reload"
+    assert matrix.get_change_action("caches.cache_autotuning") is None
+    assert matrix.get_change_action("listeners") is None
+
+
+def test_apply_synapse_config_changes(matrix, mock_check_call, mock_host_service):
+    """Test config changes are applied with the smallest action needed."""
+    matrix.charm_config["workers"] = "synchrotron=1,federation_reader=1"
+    previous = {
+        "caches": {"global_factor": 1.0},
+        "enable_room_list_search": False,
+        "listeners": [],
+    }
+    matrix.apply_synapse_config_changes(
+        previous, dict(previous, caches={"global_factor": 2.0})
+    )
+    assert mock_host_service.call_count == 0
+    mock_check_call.assert_any_call(
+        ["systemctl", "kill", "--signal=SIGHUP", "--kill-who=main", matrix.synapse_service]
+    )
+    assert mock_check_call.call_count == 3
+
+    matrix.apply_synapse_config_changes(previous, dict(previous, enable_room_list_search=True))
+    assert mock_host_service.call_args_list == [
+        mock.call("restart", "matrix-synapse-worker-synchrotron1"),
+        mock.call("restart", matrix.synapse_service),
+    ]
+
+    mock_host_service.reset_mock()
+    matrix.apply_synapse_config_changes(previous, dict(previous, listeners=[{}]))
+    assert mock_host_service.call_count == 3
+
+    mock_host_service.reset_mock()
+    matrix.charm_config["federation-senders"] = 1
+    matrix.apply_synapse_config_changes(
+        previous, dict(previous, federation_domain_whitelist=["mock.other"])
+    )
+    assert mock_host_service.call_args_list == [
+        mock.call("restart", "matrix-synapse-worker-federation_reader1"),
+        mock.call("restart", "matrix-synapse-worker-federation_sender1"),
+        mock.call("restart", matrix.synapse_service),
+    ]
+    matrix.charm_config["federation-senders"] = 0
+
+    mock_host_service.reset_mock()
+    workers = matrix.get_workers()
+    matrix.apply_synapse_config_changes(previous, dict(previous, enable_room_list_search=True), workers)
+    assert mock_host_service.call_args_list == [
+        mock.call("restart", "matrix-synapse-worker-federation_reader1"),
+        mock.call("restart", "matrix-synapse-worker-synchrotron1"),
+        mock.call("restart", matrix.synapse_service),
+    ]
+
+    mock_host_service.reset_mock()
+    matrix.apply_synapse_config_changes(previous, previous, workers[:1])
+    assert mock_host_service.call_args_list == [
+        mock.call("restart", "matrix-synapse-worker-synchrotron1"),
+    ]
+
+
+def test_render_template(matrix, tmpdir, monkeypatch):
+    """Test rendering is skipped when the template and its context are unchanged."""
+    target = tmpdir.join("matrix-ircd.env").strpath
+    context = {"home_server": "http://mock:8008", "bind": "127.0.0.1:6667"}
+    from charmhelpers.core import templating
+
+    mock_render = mock.Mock(wraps=templating.render)
+    monkeypatch.setattr("lib_matrix.templating.render", mock_render)
+    assert matrix.render_template("matrix-ircd.env.j2", target, context) is True
+    assert matrix.render_template("matrix-ircd.env.j2", target, dict(context)) is False
+    assert mock_render.call_count == 1
+
+    context["bind"] = "127.0.0.1:6668"
+    assert matrix.render_template("matrix-ircd.env.j2", target, context) is True
+    assert mock_render.call_count == 2
+
+    os.remove(target)
+    matrix.render_template("matrix-ircd.env.j2", target, context)
+    assert os.path.exists(target)
+    assert mock_render.call_count == 3
+
+    monkeypatch.setattr(matrix, "get_render_hash", lambda source, context: "new-template")
+    assert matrix.render_template("matrix-ircd.env.j2", target, context) is False
+    assert mock_render.call_count == 4
+
+
+def test_schedule_configure(matrix, monkeypatch):
+    """Test configuration requested several times in a hook runs once at exit."""
+    mock_atexit = mock.Mock()
+    monkeypatch.setattr("lib_matrix.hookenv.atexit", mock_atexit)
+    matrix.schedule_configure()
+    matrix.schedule_configure()
+    mock_atexit.assert_called_once_with(matrix.configure_at_exit)
+
+
+def test_get_rate_limits(matrix):
+    """Test rate limits are built from presets and overrides, and validated."""
+    assert matrix.get_rate_limits() == {}
+    matrix.charm_config["rate-limit-preset"] = "small"
+    rate_limits = matrix.get_rate_limits()
+    assert rate_limits["rc_message"] == {"per_second": 0.2, "burst_count": 10}
+    assert rate_limits["rc_login"]["failed_attempts"]["burst_count"] == 3
+    matrix.charm_config["rate-limit-overrides"] = "rc_message.per_second=1, rc_joins.local.burst_count=2.5"
+    rate_limits = matrix.get_rate_limits()
+    assert rate_limits["rc_message"] == {"per_second": 1, "burst_count": 10}
+    assert rate_limits["rc_joins"]["local"]["burst_count"] == 2.5
+    for preset, overrides in (
+        ("huge", ""),
+        ("small", "rc_message.per_minute=1"),
+        ("small", "rc_login.per_second=1"),
+        ("small", "rc_message.per_second=fast"),
+        ("small", "rc_message.per_second=-1"),
+    ):
+        matrix.charm_config["rate-limit-preset"] = preset
+        matrix.charm_config["rate-limit-overrides"] = overrides
+        try:
+            matrix.get_rate_limits()
+            assert False, "{} {} should be invalid".format(preset, overrides)
+        except ValueError:
+            pass
+
+
+def test_render_rate_limits(matrix, mock_status_set):
+    """Test rate limits are rendered, and invalid rate limits block rendering."""
+    matrix.save_pgsql_conf(db)
+    matrix.charm_config["rate-limit-preset"] = "bridge-heavy"
+    assert matrix.render_synapse_config() is True
+    with open(matrix.synapse_config) as config_file:
+        synapse_config = yaml.safe_load(config_file)
+    assert synapse_config["rc_message"] == {"per_second": 10, "burst_count": 100}
+    assert synapse_config["rc_login"]["address"]["burst_count"] == 20
+    assert synapse_config["rc_federation"]["concurrent"] == 10
+    matrix.charm_config["rate-limit-overrides"] = "rc_message.per_hour=1"
+    assert matrix.render_synapse_config() is False
+    assert "rc_message.per_hour" in matrix.render_error
 
 
 def test_configure(matrix, mock_snap):
@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+"""Test the hook profiler."""
+import subprocess
+
+from lib_matrix_profiler import HookProfiler, profile_report, start_profiling
+
+
+def test_start_profiling_disabled(matrix):
+    """Test profiling is opt-in."""
+    assert start_profiling(matrix) is None
+
+
+def test_profile_helper(matrix, mock_psycopg2, monkeypatch):
+    """Test helper methods, subprocesses and database round-trips are recorded."""
+    from test_lib import db
+
+    monkeypatch.setattr("lib_matrix_profiler.hookenv.config", lambda: {"enable-hook-profiling": True})
+    monkeypatch.setattr("lib_matrix_profiler.hookenv.hook_name", lambda: "config-changed")
+    monkeypatch.setattr("lib_matrix_profiler.hookenv.atexit", lambda callback: None)
+    profiler = start_profiling(matrix)
+    assert isinstance(profiler, HookProfiler)
+    matrix.save_pgsql_conf(db)
+    matrix.pgsql_query("SELECT 1;")
+    matrix.pgsql_query("SELECT 2;")
+    subprocesses = profiler.subprocesses
+    subprocess.check_output(["true"])
+    assert profiler.subprocesses == subprocesses + 1
+    profiler.save()
+
+    assert profiler.timings["MatrixHelper.pgsql_query"]["calls"] == 2
+    assert profiler.timings["MatrixHelper.pgsql_configured"]["calls"] >= 2
+    assert profiler.get_db_round_trips() == 2
+
+    runs = matrix.kv.get("hook-profile")
+    assert len(runs) == 1
+    assert runs[0]["hook"] == "config-changed"
+    assert runs[0]["subprocesses"] == subprocesses + 1
+    assert runs[0]["db_round_trips"] == 2
+
+    subprocess.check_output(["true"])
+    assert profiler.subprocesses == subprocesses + 1
+
+
+def test_profile_report(matrix):
+    """Test reporting of the slowest hooks and methods."""
+    matrix.kv.set(
+        "hook-profile",
+        [
+            {
+                "hook": "update-status",
+                "started": 1,
+                "wall_time": 1.0,
+                "subprocesses": 3,
+                "db_round_trips": 0,
+                "timings": {"MatrixHelper.get_server_name": {"calls": 1, "time": 0.5}},
+            },
+            {
+                "hook": "config-changed",
+                "started": 2,
+                "wall_time": 20.0,
+                "subprocesses": 30,
+                "db_round_trips": 4,
+                "timings": {
+                    "MatrixHelper.get_server_name": {"calls": 2, "time": 1.0},
+                    "MatrixHelper.configure": {"calls": 1, "time": 18.0},
+                },
+            },
+        ],
+    )
+    report = profile_report(runs=10, top=1)
+    assert report["runs"] == 2
+    assert [hook["hook"] for hook in report["hooks"]] == ["config-changed"]
+    assert report["methods"] == [{"name": "MatrixHelper.configure", "calls": 1, "time": 18.0}]
+    report = profile_report(runs=1, top=5)
+    assert report["runs"] == 1
+    assert report["methods"][1] == {"name": "MatrixHelper.get_server_name", "calls": 2, "time": 1.0}